@@ -0,0 +1,124 @@
+"""
+Per-subscription adjustments to products
+
+An Adjustment model instance attaches a named adjustment (its
+AdjustmentType's name) and a JSON value to a subscription, e.g.
+
+    Discount             {"percent": 15} or {"amount": "20.00"}
+    InclusionOverride    {"Projects": 50}
+
+Applying a subscription's adjustments to its product class yields a subclass
+of the product with the adjusted prices and inclusions. Adjusted classes are
+memoized per (product class, adjustments) in a bounded LRU, so subscriptions
+with the same terms share one class and pricing them stays cheap.
+
+Further adjustment types can be defined by subclassing Adjustment in one of
+the modules listed in the BILLING_DEFINITIONS setting. Adjustments of any
+other type (e.g. the placeholder names given to unnamed types by migration
+0011) are logged and ignored.
+"""
+
+import json
+import logging
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+
+from billing.utils import LRUCache
+
+CENT = Decimal('0.01')
+
+logger = logging.getLogger('billing.adjustments')
+
+class Adjustment(object):
+    """
+    base class for adjustments; subclasses implement get_attrs() and are
+    looked up by class name
+    """
+    def get_attrs(self, product_class, value):
+        """
+        returns a dict of the class attributes of `product_class` to
+        override, given the adjustment's value
+        """
+        raise NotImplementedError('get_attrs() should be implemented by subclass')
+
+class Discount(Adjustment):
+    """
+    takes a percentage or a fixed amount off the base price, rounding the
+    discounted price half up to cents
+    """
+    def get_attrs(self, product_class, value):
+        base_price = Decimal(str(product_class.base_price))
+        if 'percent' in value:
+            percent = Decimal(str(value['percent']))
+            base_price = base_price * (100 - percent) / 100
+        elif 'amount' in value:
+            base_price = base_price - Decimal(str(value['amount']))
+        else:
+            raise ValueError('Discounts need a "percent" or an "amount"')
+        base_price = max(base_price, Decimal(0))
+        return {'base_price': base_price.quantize(CENT, ROUND_HALF_UP)}
+
+class InclusionOverride(Adjustment):
+    """ changes the number of units included of FixedInclusion features """
+    def get_attrs(self, product_class, value):
+        from pricing.feature_pricing import FixedInclusion
+        from billing.features import get_features
+        features = dict(get_features(product_class))
+        attrs = {}
+        for name, included in value.items():
+            feature = features.get(name)
+            if feature is None or  \
+                    not isinstance(feature.pricing_scheme, FixedInclusion):
+                raise ValueError(
+                    '%s has no FixedInclusion feature named "%s"' %
+                    (product_class.name, name))
+            attrs[str(name)] = type(feature)(str(name), (feature,), {
+                'pricing_scheme': FixedInclusion(included=included)})
+        return attrs
+
+BUILTIN_ADJUSTMENTS = (Discount, InclusionOverride)
+
+
+ADJUSTED_PRODUCT_CACHE_SIZE = getattr(settings,
+    'BILLING_ADJUSTED_PRODUCT_CACHE_SIZE', 1000)
+
+adjusted_product_cache = LRUCache(ADJUSTED_PRODUCT_CACHE_SIZE)
+
+def get_fingerprint(adjustments):
+    """
+    returns a hashable key for a sequence of (adjustment name, value) pairs
+    """
+    return tuple((name, json.dumps(value, sort_keys=True))
+        for name, value in adjustments)
+
+def get_adjusted_product_class(product_class, adjustments):
+    """
+    returns `product_class` with the given (adjustment name, value) pairs
+    applied in turn, or `product_class` itself if there are none
+
+    Adjustments whose names aren't adjustment classes are skipped.
+    """
+    import billing.loading
+    known = billing.loading.get_adjustments_cache()
+    unknown = [name for name, value in adjustments if name not in known]
+    if unknown:
+        logger.warning('Ignoring unknown adjustment types: %s',
+            ', '.join(unknown))
+        adjustments = [(name, value) for name, value in adjustments
+            if name in known]
+    if not adjustments:
+        return product_class
+    key = (product_class, get_fingerprint(adjustments))
+    adjusted = adjusted_product_cache.get(key)
+    if adjusted is None:
+        adjusted = product_class
+        for name, value in adjustments:
+            adjustment = billing.loading.get_adjustment(name)()
+            attrs = adjustment.get_attrs(adjusted, value)
+            attrs.setdefault('name', product_class.name)
+            attrs.setdefault('__module__', product_class.__module__)
+            adjusted = type(adjusted)(product_class.__name__, (adjusted,), attrs)
+        adjusted.unadjusted_product_class = product_class
+        adjusted_product_cache.set(key, adjusted)
+    return adjusted
@@ -1,5 +1,6 @@
 from billing.models import Account, ProductType, Subscription, SubscriptionApprovalStatus
 from django.contrib import admin
+from django.contrib.admin.views.main import IS_POPUP_VAR
 
 from .loading import get_products
 
@@ -13,30 +14,45 @@ def subscribe_actions_iter():
     for product in get_products(hidden=True):
         def create_subscribe_action(product):
             def subscribe_action(modeladmin, request, accounts):
-                for account in accounts:
-                    account.subscribe_to_product(product)
-                if len(accounts) == 1:
+                subs = Subscription.objects.bulk_create_from_product(
+                    product, accounts)
+                if len(subs) == 1:
                     message_bit = '1 user was'
                 else:
-                    message_bit = '%s users were' % len(accounts)
+                    message_bit = '%s users were' % len(subs)
                 message = '%s successfully subscribed to %s' % (message_bit, product.name)
                 modeladmin.message_user(request, message)
             subscribe_action.__name__ = 'subscribe_to_%s' % product.name
+            subscribe_action.short_description = 'Subscribe to %s' % product.name
             return subscribe_action
         yield create_subscribe_action(product)
 
+def current_product(account):
+    pc = account.get_current_product_class()
+    return pc.name if pc else None
+
 class AccountAdmin(admin.ModelAdmin):
     search_fields = ['owner__id', 'owner__username', 'owner__email']
     list_display = [
         '__unicode__',
-        lambda x: x.get_current_product_class().name,
+        current_product,
         lambda x: x.owner.id,
         lambda x: x.owner.username,
         lambda x: x.owner.email,
     ]
-    actions = list(subscribe_actions_iter())
     inlines = [SubscriptionInline]
     raw_id_fields = ['owner']
+    def get_actions(self, request):
+        # built per request so the product catalog isn't loaded at import time
+        actions = super(AccountAdmin, self).get_actions(request)
+        if IS_POPUP_VAR not in request.GET:
+            for action in subscribe_actions_iter():
+                name = action.__name__
+                actions[name] = (action, name, action.short_description)
+        return actions
+    def queryset(self, request):
+        qs = super(AccountAdmin, self).queryset(request)
+        return qs.with_current_product()
 
 class SubscriptionAdmin(admin.ModelAdmin):
     list_filter = ['product_type']
@@ -0,0 +1,183 @@
+"""
+Pluggable subscription approval backends
+
+New subscriptions are handed to the approval backend named by the
+BILLING_APPROVAL_BACKEND setting. The default, SyncApprovalBackend, sends
+ready_for_approval (or batch_ready_for_approval) straight away, so any
+processor receivers run inside the subscribing request.
+
+DatabaseApprovalBackend instead queues an ApprovalJob for each subscription,
+leaving it pending, and the process_approval_jobs management command sends
+the signals from a worker:
+
+    BILLING_APPROVAL_BACKEND = 'billing.approval.DatabaseApprovalBackend'
+
+    $ ./manage.py process_approval_jobs --loop
+
+Either way, processors record their decisions with
+Subscription.set_current_approval_status().
+"""
+
+import datetime
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from billing.instrumentation import instrumented
+from billing.loading import import_item
+from billing.signals import ready_for_approval, batch_ready_for_approval
+from billing.utils import chunked
+
+APPROVAL_BACKEND = getattr(settings, 'BILLING_APPROVAL_BACKEND',
+    'billing.approval.SyncApprovalBackend')
+# claimed jobs whose worker hasn't finished them in this many seconds are
+# assumed to have been abandoned and may be claimed again
+APPROVAL_JOB_CLAIM_TIMEOUT = getattr(settings,
+    'BILLING_APPROVAL_JOB_CLAIM_TIMEOUT', 600)
+APPROVAL_JOB_MAX_ATTEMPTS = getattr(settings,
+    'BILLING_APPROVAL_JOB_MAX_ATTEMPTS', 5)
+# failed jobs wait this many seconds before their first retry, doubling
+# with each further attempt
+APPROVAL_JOB_RETRY_DELAY = getattr(settings,
+    'BILLING_APPROVAL_JOB_RETRY_DELAY', 30)
+
+def send_approval_signals(subscriptions):
+    """
+    asks the processors to approve the given subscriptions, as a batch if
+    there are several and a processor handles batches
+    """
+    if len(subscriptions) > 1:
+        responses = batch_ready_for_approval.send(
+            sender=type(subscriptions[0]), subscriptions=subscriptions)
+        if any(r for receiver, r in responses):
+            return
+    for sub in subscriptions:
+        ready_for_approval.send(sender=sub)
+
+
+class BaseApprovalBackend(object):
+    def request_approval(self, subscriptions):
+        raise NotImplementedError(
+            'request_approval() should be implemented by subclass')
+
+class SyncApprovalBackend(BaseApprovalBackend):
+    """ requests approval immediately, in the current thread """
+    def request_approval(self, subscriptions):
+        send_approval_signals(subscriptions)
+
+class DatabaseApprovalBackend(BaseApprovalBackend):
+    """ queues an ApprovalJob for each subscription """
+    def request_approval(self, subscriptions):
+        from billing.models import ApprovalJob, BULK_CHUNK_SIZE
+        for chunk in chunked(subscriptions, BULK_CHUNK_SIZE):
+            ApprovalJob.objects.bulk_create([
+                ApprovalJob(subscription_id=sub.pk) for sub in chunk])
+
+
+_backends = {}
+
+def get_backend():
+    """ returns the (shared) instance of the configured approval backend """
+    path = getattr(settings, 'BILLING_APPROVAL_BACKEND', APPROVAL_BACKEND)
+    try:
+        return _backends[path]
+    except KeyError:
+        backend = _backends[path] = import_item(path)()
+        return backend
+
+
+def claim_jobs(batch_size=100, claim_timeout=APPROVAL_JOB_CLAIM_TIMEOUT):
+    """
+    claims up to `batch_size` queued (or abandoned) jobs for this worker and
+    returns them. Failed jobs aren't claimed again until their retry is due
+
+    Jobs are claimed by tagging them with a fresh token in a single UPDATE
+    whose WHERE clause re-checks that they are still claimable, so
+    concurrent workers never claim the same job; a job claimed by another
+    worker between the two queries is simply skipped.
+    """
+    from billing.models import ApprovalJob
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(seconds=claim_timeout)
+    claimable = ApprovalJob.objects.filter(
+        Q(status=ApprovalJob.STATUS.queued) |
+        Q(status=ApprovalJob.STATUS.claimed, date_claimed__lt=cutoff))  \
+        .filter(Q(not_before__isnull=True) | Q(not_before__lte=now))
+    candidates = list(claimable.order_by('pk')
+        .values_list('pk', flat=True)[:batch_size])
+    if not candidates:
+        return []
+    token = uuid.uuid4().hex
+    claimable.filter(pk__in=candidates).update(
+        status=ApprovalJob.STATUS.claimed, claim_token=token, date_claimed=now)
+    return list(ApprovalJob.objects
+        .filter(claim_token=token, status=ApprovalJob.STATUS.claimed)
+        .select_related('subscription', 'subscription__billing_account',
+            'subscription__product_type')
+        .order_by('pk'))
+
+@instrumented('approval.run_jobs')
+def run_jobs(jobs, max_attempts=APPROVAL_JOB_MAX_ATTEMPTS,
+        retry_delay=APPROVAL_JOB_RETRY_DELAY):
+    """
+    requests approval of the claimed jobs' subscriptions, deleting the jobs
+    that succeed. Returns the number of jobs that failed
+
+    A failed job is queued again to be retried after `retry_delay` seconds,
+    doubling with each attempt, until it has failed `max_attempts` times.
+
+    The batch's statuses are written in one transaction. Subscriptions that
+    are no longer pending (e.g. decided by a processor which committed
+    before the batch failed) are not sent again, so retrying a batch job by
+    job doesn't record a second decision or call a gateway twice.
+    """
+    from billing.models import ApprovalJob, Subscription
+    pending = set(Subscription.objects.filter(
+        pk__in=[job.subscription_id for job in jobs],
+        current_status=Subscription.APPROVAL_STATUS.pending,
+    ).values_list('pk', flat=True))
+    subscriptions = [job.subscription for job in jobs
+        if job.subscription_id in pending]
+    try:
+        with transaction.commit_on_success():
+            if subscriptions:
+                send_approval_signals(subscriptions)
+    except Exception:
+        if len(jobs) == 1:
+            job = jobs[0]
+            job.attempts += 1
+            job.last_error = traceback.format_exc()
+            if job.attempts < max_attempts:
+                job.status = ApprovalJob.STATUS.queued
+                job.not_before = datetime.datetime.now() +  \
+                    datetime.timedelta(
+                        seconds=retry_delay * 2 ** (job.attempts - 1))
+            else:
+                job.status = ApprovalJob.STATUS.failed
+            job.claim_token = ''
+            job.save()
+            return 1
+        # retry one by one, so a single bad subscription doesn't fail the
+        # whole batch
+        return sum(run_jobs([job], max_attempts, retry_delay) for job in jobs)
+    ApprovalJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+    return 0
+
+def process_approval_jobs(batch_size=100, max_batches=None):
+    """
+    claims and runs queued jobs, batch by batch, until the queue is empty (or
+    `max_batches` batches have been run). Returns the number of jobs run and
+    the number of those that failed
+    """
+    run = failed = batches = 0
+    while max_batches is None or batches < max_batches:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            break
+        failed += run_jobs(jobs)
+        run += len(jobs)
+        batches += 1
+    return run, failed
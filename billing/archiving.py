@@ -0,0 +1,98 @@
+"""
+Compaction of the subscription approval status history
+
+SubscriptionApprovalStatus is append-only. compact_approval_statuses() moves
+statuses older than a cutoff out of it, into the ArchivedApprovalStatus
+table or an archive file, so the hot table only holds recent history. The
+newest status of each subscription (the one its current_status was copied
+from) is always kept, so current statuses don't change.
+
+Statuses are moved in batches, each committed on its own, and moved
+statuses are removed from the status table, so an interrupted compaction
+simply carries on where it left off when run again. Archive files are
+written before each batch is deleted; after an interruption a file may
+repeat a batch, which can be recognised by the statuses' original ids.
+"""
+
+import csv
+import json
+
+from django.db.models import F
+
+from billing.utils import commit_on_success_unless_managed
+
+ARCHIVE_FIELDS = ('original_id', 'subscription_id', 'status', 'note', 'created')
+
+class DatabaseArchive(object):
+    """ archives statuses to the ArchivedApprovalStatus table """
+    def write(self, rows):
+        from billing.models import ArchivedApprovalStatus, BULK_CHUNK_SIZE
+        from billing.utils import chunked
+        for chunk in chunked(rows, BULK_CHUNK_SIZE):
+            ArchivedApprovalStatus.objects.bulk_create([
+                ArchivedApprovalStatus(**row) for row in chunk])
+
+class JSONLinesArchive(object):
+    """ archives statuses to a file, one JSON object per line """
+    def __init__(self, f):
+        self.f = f
+    def write(self, rows):
+        for row in rows:
+            row = dict(row, created=row['created'].isoformat())
+            self.f.write(json.dumps(row, sort_keys=True) + '\n')
+        self.f.flush()
+
+class CSVArchive(object):
+    """ archives statuses to a CSV file with a column per ARCHIVE_FIELDS """
+    def __init__(self, f):
+        self.f = f
+        self.writer = csv.writer(f)
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow([unicode(row[field]).encode('utf-8')
+                for field in ARCHIVE_FIELDS])
+        self.f.flush()
+
+def get_compactable_statuses(before):
+    """
+    returns the statuses created before `before` which aren't their
+    subscription's newest status
+    """
+    from billing.models import SubscriptionApprovalStatus
+    return SubscriptionApprovalStatus.objects  \
+        .filter(created__lt=before)  \
+        .filter(created__lt=F('subscription__current_status_date'))
+
+def compact_approval_statuses(before, archive=None, batch_size=1000,
+        max_batches=None):
+    """
+    moves the compactable statuses created before `before` to `archive`
+    (by default, a DatabaseArchive) in batches of `batch_size`, returning
+    the number of statuses moved
+    """
+    from billing.models import SubscriptionApprovalStatus
+    if archive is None:
+        archive = DatabaseArchive()
+    statuses = get_compactable_statuses(before).order_by('pk')
+    moved = batches = 0
+    last_pk = 0
+    while max_batches is None or batches < max_batches:
+        rows = list(statuses.filter(pk__gt=last_pk).values(
+            'pk', 'subscription', 'status', 'note', 'created')[:batch_size])
+        if not rows:
+            break
+        rows = [{
+            'original_id': row['pk'],
+            'subscription_id': row['subscription'],
+            'status': row['status'],
+            'note': row['note'],
+            'created': row['created'],
+        } for row in rows]
+        with commit_on_success_unless_managed():
+            archive.write(rows)
+            SubscriptionApprovalStatus.objects.filter(
+                pk__in=[row['original_id'] for row in rows]).delete()
+        last_pk = rows[-1]['original_id']
+        moved += len(rows)
+        batches += 1
+    return moved
@@ -0,0 +1,209 @@
+"""
+Synthetic-data benchmarks for the billing ORM paths
+
+run_benchmarks() loads a synthetic population of accounts, subscriptions and
+approval statuses into the default database, times the hot billing paths
+against it and rolls everything back. Results are plain dicts (see the
+benchmark_billing management command, which writes them as JSON) so runs can
+be compared across upgrades:
+
+    {'scale': 10000, 'benchmark': 'get_current_subscription',
+     'iterations': 100, 'seconds': 0.41, 'queries': 100, ...}
+
+Point the command at a throwaway database (e.g. a local Postgres) with
+--settings to benchmark something other than the project's usual database.
+The cache is cleared between scales, so don't share it with a live site.
+The admin changelist is benchmarked without rendering its template.
+"""
+
+import datetime
+import random
+import time
+
+from django.core.cache import cache
+from django.db import connection, transaction, DEFAULT_DB_ALIAS
+
+from billing.processor.utils import router as processor_router
+from billing.utils import chunked, encode_bitmap
+
+DEFAULT_SCALES = (1000, 10000)
+
+class QueryCounter(object):
+    """ counts the queries run on the default connection within a block """
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+    def __exit__(self, *exc_info):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.use_debug_cursor
+        del connection.queries[self.start:]
+
+
+def generate(n_accounts, subscriptions_per_account=2,
+        statuses_per_subscription=3, seed=0):
+    """
+    creates `n_accounts` users and billing accounts, each with the given
+    number of subscriptions to random products, each with the given number
+    of approval statuses. Returns the pks of the new accounts
+    """
+    from django.contrib.auth.models import User
+    from billing.models import Account, ProductType, Subscription,  \
+        SubscriptionApprovalStatus, BULK_CHUNK_SIZE
+    rand = random.Random(seed)
+    product_type_ids = list(ProductType.objects.values_list('pk', flat=True))
+    statuses = [s[0] for s in Subscription.APPROVAL_STATUS]
+    now = datetime.datetime.now().replace(microsecond=0)
+
+    def bulk_create(model, objs):
+        """ inserts the objects, returning the pks of the new rows """
+        rows = model.objects.using(DEFAULT_DB_ALIAS)
+        last_pk = rows.order_by('-pk').values_list('pk', flat=True)[:1]
+        last_pk = last_pk[0] if last_pk else 0
+        for chunk in chunked(objs, BULK_CHUNK_SIZE):
+            model.objects.bulk_create(chunk)
+        return list(rows.filter(pk__gt=last_pk)
+            .order_by('pk').values_list('pk', flat=True))
+
+    user_ids = bulk_create(User, (
+        User(username='billing-bench-%s' % i, password='!')
+        for i in xrange(n_accounts)))
+    product_choices = [
+        [rand.choice(product_type_ids) for i in xrange(subscriptions_per_account)]
+        for user_id in user_ids]
+    def accounts():
+        for user_id, choices in zip(user_ids, product_choices):
+            mask = 0
+            for product_type_id in choices:
+                mask |= 1 << product_type_id
+            yield Account(owner_id=user_id,
+                subscribed_product_types=encode_bitmap(mask))
+    account_ids = bulk_create(Account, accounts())
+    status_choices = []
+    def subscriptions():
+        for account_id, choices in zip(account_ids, product_choices):
+            for product_type_id in choices:
+                sub_statuses = ['pending'] + [rand.choice(statuses)
+                    for j in xrange(statuses_per_subscription - 1)]
+                status_choices.append(sub_statuses)
+                yield Subscription(billing_account_id=account_id,
+                    product_type_id=product_type_id,
+                    current_status=sub_statuses[-1],
+                    current_status_date=now)
+    subscription_ids = bulk_create(Subscription, subscriptions())
+    def approval_statuses():
+        for sub_id, sub_statuses in zip(subscription_ids, status_choices):
+            for i, status in enumerate(sub_statuses):
+                created = now - datetime.timedelta(
+                    seconds=len(sub_statuses) - i - 1)
+                yield SubscriptionApprovalStatus(subscription_id=sub_id,
+                    status=status, created=created, modified=created)
+    bulk_create(SubscriptionApprovalStatus, approval_statuses())
+    return account_ids
+
+
+def measure(func, iterations):
+    """ returns the wall time and query count of calling `func` repeatedly """
+    with QueryCounter() as queries:
+        start = time.time()
+        for i in xrange(iterations):
+            func(i)
+        seconds = time.time() - start
+    return {
+        'iterations': iterations,
+        'seconds': seconds,
+        'seconds_per_iteration': seconds / iterations,
+        'queries': queries.count,
+        'queries_per_iteration': float(queries.count) / iterations,
+    }
+
+def get_benchmarks(account_ids, sample_size):
+    """ returns a list of (name, function, iterations) benchmarks """
+    from django.contrib.auth.models import User
+    from django.test.client import RequestFactory
+    from billing.models import Account, Subscription,  \
+        ACTIVE_SUBSCIPRTION_STATUSES
+    from billing.views import subscription_view
+    import billing.loading
+    rand = random.Random(1)
+    sample = rand.sample(account_ids, min(sample_size, len(account_ids)))
+    products = billing.loading.get_products()
+    factory = RequestFactory()
+
+    def get_current_subscription(i):
+        Account.objects.get(pk=sample[i]).get_current_subscription()
+    def filter_by_current_statuses(i):
+        list(Subscription.objects
+            .filter_by_current_statuses(ACTIVE_SUBSCIPRTION_STATUSES)
+            .order_by('-pk')[:100])
+    def get_visible_products(i):
+        Account.objects.get(pk=sample[i]).get_visible_products()
+    def admin_changelist(i):
+        from django.contrib.admin.sites import AdminSite
+        from billing.admin import AccountAdmin
+        model_admin = AccountAdmin(Account, AdminSite())
+        request = factory.get('/admin/billing/account/', {'p': i})
+        request.user = User(is_active=True, is_staff=True, is_superuser=True)
+        response = model_admin.changelist_view(request)
+        # do the work the changelist template would do
+        cl = response.context_data['cl']
+        for account in cl.result_list:
+            for field in cl.list_display:
+                if callable(field):
+                    field(account)
+    dispatch = subscription_view()
+    def subscription_view_dispatch(i):
+        account = Account.objects.select_related('owner').get(pk=sample[i])
+        request = factory.get('/billing/subscription/')
+        request.user = account.owner
+        request.user.billing_account = account
+        dispatch(request, product=products[i % len(products)].name)
+
+    return [
+        ('get_current_subscription', get_current_subscription, len(sample)),
+        ('filter_by_current_statuses', filter_by_current_statuses, 10),
+        ('get_visible_products', get_visible_products, len(sample)),
+        ('admin_changelist', admin_changelist,
+            min(10, max(1, len(account_ids) // 100))),
+        ('subscription_view_dispatch', subscription_view_dispatch, len(sample)),
+    ]
+
+def run_benchmarks(scales=DEFAULT_SCALES, subscriptions_per_account=2,
+        statuses_per_subscription=3, sample_size=100, only=None):
+    """
+    benchmarks each path at each scale (a number of accounts), returning a
+    list of result dicts. The generated data is rolled back after each scale
+    """
+    results = []
+    for scale in scales:
+        with transaction.commit_manually():
+            try:
+                start = time.time()
+                account_ids = generate(scale, subscriptions_per_account,
+                    statuses_per_subscription)
+                setup_seconds = time.time() - start
+                for name, func, iterations in get_benchmarks(
+                        account_ids, sample_size):
+                    if only and name not in only:
+                        continue
+                    cache.clear()
+                    result = {
+                        'scale': scale,
+                        'benchmark': name,
+                        'subscriptions': scale * subscriptions_per_account,
+                        'approval_statuses': scale *
+                            subscriptions_per_account * statuses_per_subscription,
+                        'setup_seconds': setup_seconds,
+                    }
+                    try:
+                        result.update(measure(func, iterations))
+                    except Exception as e:
+                        result['error'] = '%s: %s' % (type(e).__name__, e)
+                    results.append(result)
+            finally:
+                transaction.rollback()
+                # cached entries are keyed by pks the rollback freed up
+                cache.clear()
+                processor_router.clear()
+    return results
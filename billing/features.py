@@ -0,0 +1,38 @@
+"""
+Introspection of the features and pricing schemes of product classes
+
+Features are the inner classes of a product which declare a
+`pricing_scheme` (see example_saas_project/core/products.py).
+"""
+
+def get_features(product_class):
+    """ returns a list of (name, feature class) pairs, sorted by name """
+    features = []
+    for name in dir(product_class):
+        if name.startswith('_'):
+            continue
+        attr = getattr(product_class, name, None)
+        if isinstance(attr, type) and hasattr(attr, 'pricing_scheme'):
+            features.append((name, attr))
+    return features
+
+def get_inclusion_limits(product_class):
+    """
+    returns a dict mapping the name of each feature priced with a
+    FixedInclusion to the number of units included
+    """
+    from pricing.feature_pricing import FixedInclusion
+    return dict((name, feature.pricing_scheme.included)
+        for name, feature in get_features(product_class)
+        if isinstance(feature.pricing_scheme, FixedInclusion))
+
+def get_unit_prices(product_class):
+    """
+    returns a dict mapping the name of each feature priced with a
+    FixedUnitPricing to its (Decimal) unit price
+    """
+    from decimal import Decimal
+    from pricing.feature_pricing import FixedUnitPricing
+    return dict((name, Decimal(str(feature.pricing_scheme.unit_price)))
+        for name, feature in get_features(product_class)
+        if isinstance(feature.pricing_scheme, FixedUnitPricing))
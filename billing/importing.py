@@ -0,0 +1,179 @@
+"""
+Bulk subscription imports
+
+import_subscriptions() subscribes users to products from a stream of
+(line number, user, product) rows, such as those read from a CSV or JSONL
+file by read_csv() or read_jsonl(). Users may be given by id or username,
+just as for the subscribe_user_to_product command. Rows are processed in
+chunks: each chunk's users are looked up in a couple of queries and its
+subscriptions are created with Subscription.objects.bulk_create_from_product(),
+so memory use doesn't grow with the size of the import.
+
+Several rows for the same user are applied in file order, so the last one
+decides the user's current subscription. Rows which can't be imported are
+passed to an `on_failure(line, user, message)` callback and skipped; the
+rest of the import carries on.
+"""
+
+import csv
+import json
+
+from django.db import DEFAULT_DB_ALIAS
+
+from billing.utils import chunked
+
+def read_csv(f, encoding='utf-8'):
+    """
+    yields (line number, user, product) rows from a CSV file with two
+    columns, skipping a header row of 'user,product'
+
+    The cells are decoded from `encoding`, so that users and products are
+    unicode, as they are when read from JSONL.
+    """
+    for line, row in enumerate(csv.reader(f), 1):
+        try:
+            row = [c.decode(encoding).strip() for c in row]
+        except UnicodeDecodeError:
+            yield line, None, None
+            continue
+        if not row or (line == 1 and row == ['user', 'product']):
+            continue
+        if len(row) != 2:
+            yield line, None, None
+        else:
+            yield line, row[0], row[1]
+
+def read_jsonl(f):
+    """
+    yields (line number, user, product) rows from a file with one JSON
+    object, with 'user' and 'product' keys, per line
+    """
+    for line, text in enumerate(f, 1):
+        if not text.strip():
+            continue
+        try:
+            obj = json.loads(text)
+            user, product = obj['user'], obj['product']
+        except (ValueError, KeyError, TypeError):
+            yield line, None, None
+            continue
+        if isinstance(user, bool) or  \
+                not isinstance(user, (basestring, int, long)) or  \
+                not isinstance(product, basestring):
+            yield line, None, None
+        else:
+            yield line, unicode(user), product
+
+def resolve_users(user_refs):
+    """
+    returns a dict mapping each of the given ids or usernames to a matching
+    user, or to an error message
+    """
+    from django.contrib.auth.models import User
+    from billing.models import MAX_QUERY_PARAMS
+    user_refs = set(user_refs)
+    ids = set()
+    for ref in user_refs:
+        try:
+            ids.add(int(ref))
+        except ValueError:
+            pass
+    by_id = {}
+    for chunk in chunked(ids, MAX_QUERY_PARAMS):
+        by_id.update(User.objects.in_bulk(chunk))
+    by_name = {}
+    for chunk in chunked(user_refs, MAX_QUERY_PARAMS):
+        by_name.update((u.username, u)
+            for u in User.objects.filter(username__in=chunk))
+    users = {}
+    for ref in user_refs:
+        user_by_name = by_name.get(ref)
+        try:
+            user_by_id = by_id.get(int(ref))
+        except ValueError:
+            user_by_id = None
+        if user_by_name is None and user_by_id is None:
+            users[ref] = 'No such user found'
+        elif user_by_name is not None and user_by_id is not None  \
+                and user_by_name != user_by_id:
+            users[ref] = 'Two users match: one by id and one by username'
+        else:
+            users[ref] = user_by_name or user_by_id
+    return users
+
+def get_accounts(users):
+    """
+    returns a dict mapping the pk of each of the given users to their
+    billing account, creating any missing accounts in bulk
+    """
+    from billing.models import Account, BULK_CHUNK_SIZE, MAX_QUERY_PARAMS
+    # read from the primary, so accounts a lagging replica hasn't seen yet
+    # aren't created twice (see billing.replicas)
+    accounts = Account.objects.using(DEFAULT_DB_ALIAS)
+    def get_existing(user_ids):
+        for chunk in chunked(user_ids, MAX_QUERY_PARAMS):
+            for account in accounts.filter(owner__in=chunk):
+                yield account.owner_id, account
+    user_ids = set(u.pk for u in users)
+    existing = dict(get_existing(user_ids))
+    missing = user_ids.difference(existing)
+    if missing:
+        for chunk in chunked(missing, BULK_CHUNK_SIZE):
+            Account.objects.bulk_create(
+                [Account(owner_id=user_id) for user_id in chunk])
+        existing.update(get_existing(missing))
+    return existing
+
+def import_subscriptions(rows, chunk_size=1000, on_failure=None):
+    """
+    subscribes the users to the products given by `rows`, an iterable of
+    (line number, user, product) tuples. Returns the number of subscriptions
+    created and the number of rows which failed
+    """
+    import billing.loading
+    from billing.models import Subscription
+    product_names = set(p.name for p in billing.loading.get_products(hidden=True))
+    imported = failed = 0
+    def fail(line, user_ref, message):
+        if on_failure is not None:
+            on_failure(line, user_ref, message)
+        return 1
+    for chunk in chunked(rows, chunk_size):
+        valid_rows = []
+        for line, user_ref, product_name in chunk:
+            if user_ref is None:
+                failed += fail(line, user_ref, 'Malformed row')
+            elif product_name not in product_names:
+                failed += fail(line, user_ref,
+                    'No such product: %s' % product_name)
+            else:
+                valid_rows.append((line, user_ref, product_name))
+        users = resolve_users(ref for line, ref, name in valid_rows)
+        accounts = get_accounts(
+            [u for u in users.values() if not isinstance(u, basestring)])
+        # each user's nth row goes in the nth round, so a user's rows are
+        # applied in order while each round is still subscribed in bulk
+        rounds = []
+        row_counts = {}
+        for line, user_ref, product_name in valid_rows:
+            user = users[user_ref]
+            if isinstance(user, basestring):
+                failed += fail(line, user_ref, user)
+                continue
+            n = row_counts[user.pk] = row_counts.get(user.pk, 0) + 1
+            if n > len(rounds):
+                rounds.append({})
+            rounds[n - 1].setdefault(product_name, []).append(
+                (line, user_ref, accounts[user.pk]))
+        for by_product in rounds:
+            for product_name, product_rows in sorted(by_product.items()):
+                try:
+                    subs = Subscription.objects.bulk_create_from_product(
+                        product_name,
+                        [account for l, r, account in product_rows])
+                except Exception as e:
+                    for line, user_ref, account in product_rows:
+                        failed += fail(line, user_ref, str(e))
+                else:
+                    imported += len(subs)
+    return imported, failed
@@ -0,0 +1,153 @@
+"""
+Timing and query counts for the billing hot paths
+
+When enabled, each operation decorated with instrumented() sends the
+operation_timed signal with its wall time and the number of queries it ran
+on all databases. Receivers ("sinks") can log the timings, keep a
+histogram or forward them to a metrics system:
+
+    BILLING_INSTRUMENTATION = True
+    BILLING_INSTRUMENTATION_SINKS = (
+        'billing.instrumentation.LoggingSink',
+        'billing.instrumentation.histogram',
+    )
+
+Instrumentation can also be switched on and off at runtime with enable() and
+disable(). While disabled, an instrumented call costs one extra function
+call and a global lookup.
+
+Nested operations are each reported, and an outer operation's figures
+include those of the operations it calls.
+
+Queries are counted from the connections' query logs, which Django only
+clears at the start of each request, so long-running processes that enable
+instrumentation outside of DEBUG should call django.db.reset_queries() from
+time to time.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+from billing.signals import operation_timed
+
+logger = logging.getLogger('billing.instrumentation')
+
+enabled = False
+
+def instrumented(operation):
+    """ decorator that reports the function's calls as `operation` """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            # (connection, use_debug_cursor, queries logged so far) for each
+            # database, since reads may be routed to replicas
+            counted = []
+            for conn in connections.all():
+                counted.append(
+                    (conn, conn.use_debug_cursor, len(conn.queries)))
+                conn.use_debug_cursor = True
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                queries = 0
+                for conn, use_debug_cursor, start_queries in counted:
+                    # leave the log alone; outer counters (such as
+                    # assertNumQueries) may still be counting it
+                    queries += len(conn.queries) - start_queries
+                    conn.use_debug_cursor = use_debug_cursor
+                operation_timed.send(sender=func, operation=operation,
+                    seconds=seconds, queries=queries)
+        return wrapper
+    return decorator
+
+
+class Sink(object):
+    """ an operation_timed receiver; subclasses implement record() """
+    def __call__(self, sender, operation, seconds, queries, **kwargs):
+        self.record(operation, seconds, queries)
+    def record(self, operation, seconds, queries):
+        raise NotImplementedError('record() should be implemented by subclass')
+
+class LoggingSink(Sink):
+    """ logs each operation to the 'billing.instrumentation' logger """
+    def record(self, operation, seconds, queries):
+        logger.debug('%s took %.2fms and %s queries',
+            operation, seconds * 1000, queries)
+
+class HistogramSink(Sink):
+    """
+    keeps, per operation, a histogram of wall times (in milliseconds,
+    bucketed by the upper bounds in `buckets`) and running totals
+    """
+    def __init__(self, buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+    def record(self, operation, seconds, queries):
+        bucket = bisect.bisect_left(self.buckets, seconds * 1000)
+        with self._lock:
+            try:
+                stats = self.stats[operation]
+            except KeyError:
+                stats = self.stats[operation] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'queries': 0, 'max_queries': 0,
+                    'histogram': [0] * (len(self.buckets) + 1),
+                }
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['queries'] += queries
+            stats['max_queries'] = max(stats['max_queries'], queries)
+            stats['histogram'][bucket] += 1
+    def snapshot(self):
+        """
+        returns a copy of the statistics, mapping each operation to its
+        call count, total and max seconds and queries, and its histogram (a
+        list of counts, one per bucket plus one for slower calls)
+        """
+        with self._lock:
+            return dict((operation, dict(stats, histogram=list(stats['histogram'])))
+                for operation, stats in self.stats.items())
+
+histogram = HistogramSink()
+
+
+def connect_sink(sink):
+    """ starts sending timings to `sink` (a Sink, or a dotted path to one) """
+    dispatch_uid = sink
+    if isinstance(sink, basestring):
+        from billing.loading import import_item
+        sink = import_item(sink)
+    if isinstance(sink, type):
+        sink = sink()
+    if not isinstance(dispatch_uid, basestring):
+        dispatch_uid = id(sink)
+    operation_timed.connect(sink, weak=False, dispatch_uid=dispatch_uid)
+    return sink
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+for _sink in getattr(settings, 'BILLING_INSTRUMENTATION_SINKS', ()):
+    connect_sink(_sink)
+if getattr(settings, 'BILLING_INSTRUMENTATION', False):
+    enable()
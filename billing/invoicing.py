@@ -0,0 +1,136 @@
+"""
+Batch invoice generation
+
+run_billing() walks every account in primary key order, a chunk at a time.
+For each chunk it resolves, in bulk, the subscriptions in effect at the end
+of the period (the newest active subscription created by then) and the
+accounts' usage, prices them, and inserts the invoices and their line items
+with bulk inserts. A plan change during the period is billed in full at the
+new plan; changes after the period's end don't affect it. Accounts without
+a subscription are invoiced for BILLING_DEFAULT_PRODUCT, if there is one.
+
+Each chunk is committed together with the run's checkpoint, so memory use
+stays bounded and an interrupted run can simply be restarted.
+"""
+
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from billing.features import get_inclusion_limits, get_unit_prices
+from billing.utils import chunked, commit_on_success_unless_managed
+
+CENT = Decimal('0.01')
+
+def to_decimal(value):
+    return Decimal(str(value))
+
+class ProductPricing(object):
+    """ the pricing schemes of a product class, extracted once per run """
+    def __init__(self, product_class):
+        self.product_class = product_class
+        self.base_price = to_decimal(product_class.base_price)
+        self.inclusions = sorted(get_inclusion_limits(product_class).items())
+        self.unit_prices = sorted(get_unit_prices(product_class).items())
+    def get_line_items(self, usage):
+        """
+        returns (description, feature, quantity, unit price, amount) tuples
+        for one period, given a dict mapping feature names to units used
+        """
+        name = self.product_class.name
+        items = [(name, '', 1, self.base_price,
+            self.base_price.quantize(CENT, ROUND_HALF_UP))]
+        for feature, included in self.inclusions:
+            items.append((
+                '%s (%s included)' % (feature, included),
+                feature, usage.get(feature, 0), Decimal(0), Decimal(0)))
+        for feature, unit_price in self.unit_prices:
+            used = usage.get(feature, 0)
+            amount = (unit_price * used).quantize(CENT, ROUND_HALF_UP)
+            items.append((feature, feature, used, unit_price, amount))
+        return items
+
+def run_billing(period_start, period_end, chunk_size=500):
+    """
+    invoices every account with a subscription (or a default product) for
+    the given period, resuming the period's earlier run if it was
+    interrupted. Returns the BillingRun.
+    """
+    from billing.models import Account, BillingRun
+    run, created = BillingRun.objects.get_or_create(
+        period_start=period_start, period_end=period_end)
+    if run.date_completed:
+        return run
+    accounts = Account.objects.order_by('pk')
+    pricings = {}
+    while True:
+        chunk = list(accounts.filter(pk__gt=run.last_account_id)[:chunk_size])
+        if not chunk:
+            break
+        invoice_accounts(run, chunk, pricings)
+    run.date_completed = datetime.datetime.now()
+    BillingRun.objects.filter(pk=run.pk).update(
+        date_completed=run.date_completed)
+    return run
+
+@commit_on_success_unless_managed()
+def invoice_accounts(run, accounts, pricings=None):
+    """
+    inserts the invoices for a chunk of accounts and advances the run's
+    checkpoint past them
+    """
+    import billing.loading
+    from billing.models import (BillingRun, Invoice, InvoiceLineItem,
+        ProductType, Subscription, UsageCounter)
+    if pricings is None:
+        pricings = {}
+    usage = dict((a.pk, {}) for a in accounts)
+    counters = UsageCounter.objects  \
+        .filter(billing_account__in=usage.keys())  \
+        .values_list('billing_account', 'feature', 'count')
+    for account_id, feature, count in counters:
+        usage[account_id][feature] = count
+    period_end = datetime.datetime.combine(
+        run.period_end + datetime.timedelta(days=1), datetime.time())
+    in_effect = Subscription.objects.get_current_for_accounts(
+        accounts, before=period_end)
+    Subscription.objects.prefetch_adjustments(in_effect.values())
+    default_product = billing.loading.get_default_product()
+    if default_product is not None:
+        default_product_type = ProductType.objects.get_for_product(
+            default_product)
+    line_items = {}
+    invoices = []
+    for account in accounts:
+        sub = in_effect.get(account.pk)
+        if sub is not None:
+            # adjusted classes are shared by subscriptions with the same terms
+            product_class = sub.get_adjusted_product_class()
+            product_type = sub.product_type
+        elif default_product is not None:
+            product_class = default_product
+            product_type = default_product_type
+        else:
+            continue
+        pricing = pricings.get(product_class)
+        if pricing is None:
+            pricing = pricings[product_class] = ProductPricing(product_class)
+        items = line_items[account.pk] = pricing.get_line_items(
+            usage[account.pk])
+        invoices.append(Invoice(billing_run=run, billing_account=account,
+            product_type=product_type, period_start=run.period_start,
+            period_end=run.period_end, total=sum(i[4] for i in items)))
+    for chunk in chunked(invoices, 100):
+        Invoice.objects.bulk_create(chunk)
+    # bulk_create() doesn't hand back primary keys, so look them up
+    invoice_ids = Invoice.objects  \
+        .filter(billing_run=run, billing_account__in=line_items.keys())  \
+        .values_list('billing_account', 'pk')
+    new_items = (InvoiceLineItem(invoice_id=invoice_id, description=d,
+            feature=f, quantity=q, unit_price=p, amount=a)
+        for account_id, invoice_id in invoice_ids
+        for d, f, q, p, a in line_items[account_id])
+    for chunk in chunked(new_items, 100):
+        InvoiceLineItem.objects.bulk_create(chunk)
+    run.last_account_id = accounts[-1].pk
+    BillingRun.objects.filter(pk=run.pk).update(
+        last_account_id=run.last_account_id)
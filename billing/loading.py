@@ -1,10 +1,14 @@
+import hashlib
+import threading
+
 from django.conf import settings
 
 from ordereddict import OrderedDict
 
-from pricing.products import Product
-from pricing.manual_intervention import ManualPreApproval
-#from billing.adjustments import Adjustment
+# Products and processors are loaded on first use (importing them pulls in
+# every product module and the pricing library). Preforking servers can call
+# warm() before forking to load everything up front.
+_catalog_lock = threading.RLock()
 
 def import_item(x):
     mod_name, cls_name = x.rsplit('.', 1)
@@ -16,9 +20,8 @@ def from_x_import_y(x, y):
     return getattr(module, y)
 
 
-adjustments_cache = {}
-
 def collect_products_from_modules(modules):
+    from pricing.products import Product
     products = []
     # populate the cache
     if isinstance(modules, basestring):
@@ -29,10 +32,21 @@ def collect_products_from_modules(modules):
             if isinstance(obj, type):
                 if issubclass(obj, Product):
                     products.append(obj)
-        #        if issubclass(obj, Adjustment):
-        #            adjustment_cache[name] = obj
     return products
 
+def collect_adjustments_from_modules(modules):
+    from billing.adjustments import Adjustment
+    adjustments = {}
+    if isinstance(modules, basestring):
+        modules = (modules,)
+    for module_name in modules:
+        mod = __import__(module_name, fromlist=module_name.rsplit('.', 1)[0])
+        for name, obj in mod.__dict__.items():
+            if isinstance(obj, type) and issubclass(obj, Adjustment)  \
+                    and obj is not Adjustment:
+                adjustments[name] = obj
+    return adjustments
+
 BILLING_DEFINITIONS = getattr(settings, 'BILLING_DEFINITIONS', ())
 BILLING_PRODUCTS = getattr(settings, 'BILLING_PRODUCTS', None)
 
@@ -65,34 +79,178 @@ def populate_product_cache(products=BILLING_PRODUCTS):
         """)
     return OrderedDict((pc.name, pc) for pc in product_classes)
 
-product_cache = populate_product_cache()
+product_cache = None
+
+def get_product_cache():
+    """ returns the product cache, populating it on first use """
+    global product_cache
+    if product_cache is None:
+        with _catalog_lock:
+            if product_cache is None:
+                product_cache = populate_product_cache()
+    return product_cache
+
+class CatalogIndex(object):
+    """
+    lookup structures derived from a product cache
+
+    Built once per product cache (see get_catalog_index()), so listing and
+    ranking products doesn't rescan the catalog every time.
+    """
+    def __init__(self, products):
+        from pricing.manual_intervention import ManualPreApproval
+        self.source = products
+        self.all_products = tuple(products.values())
+        self.public_products = tuple(p for p in self.all_products
+            if p.manual_intervention is not ManualPreApproval)
+        self._ranks = dict((p, i) for i, p in enumerate(self.all_products))
+        self._version = None
+    @property
+    def version(self):
+        """
+        a short hash of the catalog's products and their prices, which
+        changes whenever the catalog does (or BILLING_CATALOG_VERSION is
+        changed)
+        """
+        if self._version is None:
+            from billing.features import get_inclusion_limits, get_unit_prices
+            public = set(self.public_products)
+            description = [getattr(settings, 'BILLING_CATALOG_VERSION', '')]
+            for p in self.all_products:
+                description.append((p.name, str(p.base_price), p in public,
+                    sorted(get_inclusion_limits(p).items()),
+                    sorted((k, str(v)) for k, v in get_unit_prices(p).items())))
+            self._version = hashlib.md5(repr(description)).hexdigest()[:12]
+        return self._version
+    def get_rank(self, product):
+        """ returns the position of the product class in the catalog """
+        try:
+            return self._ranks[product]
+        except KeyError:
+            raise ValueError('%r is not in the product catalog' % product)
+
+_catalog_index = None
+
+def get_catalog_index():
+    """ returns the CatalogIndex for the current product cache """
+    global _catalog_index
+    products = get_product_cache()
+    index = _catalog_index
+    # rebuild if the cache has been swapped out since the index was built
+    if index is None or index.source is not products:
+        index = _catalog_index = CatalogIndex(products)
+    return index
+
+def get_catalog_version():
+    """ returns the version of the current product catalog """
+    return get_catalog_index().version
+
+def get_products_fingerprint(products):
+    """ returns a short hash identifying a set of products """
+    names = sorted(p.name for p in products)
+    return hashlib.md5(','.join(names)).hexdigest()[:12]
 
 def get_product(name):
     try:
-        return product_cache[name]
+        return get_product_cache()[name]
     except KeyError:
         raise ValueError('"%s" is not a valid product name' % name)
 
-#def get_adjustment(name):
-#    return adjustments_cache[name]
+def get_default_product():
+    """ returns the product named by BILLING_DEFAULT_PRODUCT, if any """
+    name = getattr(settings, 'BILLING_DEFAULT_PRODUCT', None)
+    if name is None:
+        return None
+    return get_product(name)
+
+adjustments_cache = None
+
+def get_adjustments_cache():
+    """
+    returns a dict mapping names to the built-in adjustment classes and
+    those defined in the BILLING_DEFINITIONS modules, populating it on first
+    use
+    """
+    global adjustments_cache
+    if adjustments_cache is None:
+        with _catalog_lock:
+            if adjustments_cache is None:
+                from billing.adjustments import BUILTIN_ADJUSTMENTS
+                adjustments = dict((a.__name__, a) for a in BUILTIN_ADJUSTMENTS)
+                adjustments.update(
+                    collect_adjustments_from_modules(BILLING_DEFINITIONS))
+                adjustments_cache = adjustments
+    return adjustments_cache
+
+def get_adjustment(name):
+    try:
+        return get_adjustments_cache()[name]
+    except KeyError:
+        raise ValueError('"%s" is not a valid adjustment name' % name)
 
 def get_products(hidden=False):
-    def is_hidden(product):
-        return (not hidden) and (p.manual_intervention is ManualPreApproval)
-    return [p for p in product_cache.values() if not is_hidden(p)]
+    index = get_catalog_index()
+    if hidden:
+        return list(index.all_products)
+    return list(index.public_products)
+
+def get_product_change_type(current_product, product):
+    """
+    returns 'upgrade', 'downgrade' or None (for no change) when moving from
+    `current_product` to `product`. Products later in the catalog are
+    considered upgrades.
+    """
+    if current_product is None:
+        return 'upgrade'
+    index = get_catalog_index()
+    return _change_type(index.get_rank(current_product), index.get_rank(product))
+
+def get_product_change_types(current_product, products=None):
+    """
+    returns a list of (product, change type) pairs classifying each of the
+    given products (by default, the whole catalog) against the current one
+    """
+    index = get_catalog_index()
+    if products is None:
+        products = index.all_products
+    if current_product is None:
+        return [(p, 'upgrade') for p in products]
+    current_rank = index.get_rank(current_product)
+    return [(p, _change_type(current_rank, index.get_rank(p)))
+        for p in products]
+
+def _change_type(current_rank, rank):
+    if current_rank < rank:
+        return 'upgrade'
+    elif current_rank == rank:
+        return None
+    else:
+        return 'downgrade'
 
 
-# load the billing processors
+# the billing processors
 BILLING_PROCESSORS = getattr(settings, 'BILLING_PROCESSORS', {})
 
-processor_cache = {}
+processor_cache = None
 
-for k,v in BILLING_PROCESSORS.items():
-    processor_cache[k] = import_item(v)
+def get_processor_cache():
+    """ returns the processor cache, populating it on first use """
+    global processor_cache
+    if processor_cache is None:
+        with _catalog_lock:
+            if processor_cache is None:
+                processor_cache = dict((k, import_item(v))
+                    for k, v in BILLING_PROCESSORS.items())
+    return processor_cache
 
 def get_processor(name):
     try:
-        return processor_cache[name]
+        return get_processor_cache()[name]
     except KeyError:
         raise ValueError('"%s" is not a valid processor name' % name)
 
+def warm():
+    """ loads the product and processor catalogs if not already loaded """
+    get_catalog_index()
+    get_processor_cache()
+
@@ -1,6 +1,3 @@
-import billing.models
-from billing.models import ProductType
-from billing.loading import get_products
 from django.db.models import signals
 import south.signals
 
@@ -8,30 +5,33 @@ import south.signals
 # https://github.com/django/django/blob/1.3.X/django/contrib/contenttypes/management.py
 
 def update_producttypes(app, verbosity=2, **kwargs):
-    # only do this once, after we're synced
-    if app == 'billing' or app == billing.models:
+    # only do this once, after we're synced. `app` is the app label for
+    # south's post_migrate and the models module for post_syncdb
+    if app == 'billing' or getattr(app, '__name__', None) == 'billing.models':
         update_all_producttypes(verbosity, **kwargs)
     else:
         return
-    
+
 
 def update_all_producttypes(verbosity=2, **kwargs):
-    
-    product_types = list(ProductType.objects.all())
-    for product in get_products(hidden=True):
-        try:
-            pt = ProductType.objects.get(name=product.__name__)
-            product_types.remove(pt)
-        except ProductType.DoesNotExist:
-            pt = ProductType(name=product.__name__)
-            pt.save()
-            if verbosity >= 2:
+    from billing.models import ProductType
+    from billing.loading import get_products
+
+    product_names = [product.__name__ for product in get_products(hidden=True)]
+    existing_names = set(ProductType.objects.values_list('name', flat=True))
+    new_types = [ProductType(name=name)
+        for name in product_names if name not in existing_names]
+    if new_types:
+        ProductType.objects.bulk_create(new_types)
+        if verbosity >= 2:
+            for pt in new_types:
                 print "Adding product type '%s'" % (pt.name)
     # The presence of any remaining product types means the supplied app has an
     # undefined product. Confirm that the product type is stale before deletion.
-    if product_types:
+    stale_names = sorted(existing_names.difference(product_names))
+    if stale_names:
         if kwargs.get('interactive', False):
-            prodcut_type_display = '\n'.join(['    %s' % pt.name for pt in product_types])
+            product_type_display = '\n'.join(['    %s' % name for name in stale_names])
             ok_to_delete = raw_input("""The following product types are stale and need to be deleted:
 
 %s
@@ -45,17 +45,17 @@ If you're unsure, answer 'no'.
             ok_to_delete = False
 
         if ok_to_delete == 'yes':
-            for pt in product_types:
-                if verbosity >= 2:
-                    print "Deleting stale product type '%s'" % pt.name
-                pt.delete()
+            if verbosity >= 2:
+                for name in stale_names:
+                    print "Deleting stale product type '%s'" % name
+            ProductType.objects.filter(name__in=stale_names).delete()
         else:
             if verbosity >= 2:
                 print "Stale product types remain."
-            
+
 
 signals.post_syncdb.connect(update_producttypes)
 south.signals.post_migrate.connect(update_producttypes)
 
 if __name__ == "__main__":
-    update_all_contenttypes()
+    update_all_producttypes()
@@ -0,0 +1,187 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'BillingRun'
+        db.create_table('billing_billingrun', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('period_start', self.gf('django.db.models.fields.DateField')()),
+            ('period_end', self.gf('django.db.models.fields.DateField')()),
+            ('last_account_id', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('date_started', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('date_completed', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('billing', ['BillingRun'])
+
+        # Adding unique constraint on 'BillingRun', fields ['period_start', 'period_end']
+        db.create_unique('billing_billingrun', ['period_start', 'period_end'])
+
+        # Adding model 'Invoice'
+        db.create_table('billing_invoice', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('billing_run', self.gf('django.db.models.fields.related.ForeignKey')(related_name='invoices', to=orm['billing.BillingRun'])),
+            ('billing_account', self.gf('django.db.models.fields.related.ForeignKey')(related_name='invoices', to=orm['billing.Account'])),
+            ('product_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name='invoices', to=orm['billing.ProductType'])),
+            ('period_start', self.gf('django.db.models.fields.DateField')()),
+            ('period_end', self.gf('django.db.models.fields.DateField')()),
+            ('total', self.gf('django.db.models.fields.DecimalField')(max_digits=12, decimal_places=2)),
+            ('date_created', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+        ))
+        db.send_create_signal('billing', ['Invoice'])
+
+        # Adding unique constraint on 'Invoice', fields ['billing_run', 'billing_account']
+        db.create_unique('billing_invoice', ['billing_run_id', 'billing_account_id'])
+
+        # Adding model 'InvoiceLineItem'
+        db.create_table('billing_invoicelineitem', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('invoice', self.gf('django.db.models.fields.related.ForeignKey')(related_name='line_items', to=orm['billing.Invoice'])),
+            ('description', self.gf('django.db.models.fields.CharField')(max_length=200)),
+            ('feature', self.gf('django.db.models.fields.CharField')(max_length=100, blank=True)),
+            ('quantity', self.gf('django.db.models.fields.IntegerField')(default=1)),
+            ('unit_price', self.gf('django.db.models.fields.DecimalField')(max_digits=12, decimal_places=4)),
+            ('amount', self.gf('django.db.models.fields.DecimalField')(max_digits=12, decimal_places=2)),
+        ))
+        db.send_create_signal('billing', ['InvoiceLineItem'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'Invoice', fields ['billing_run', 'billing_account']
+        db.delete_unique('billing_invoice', ['billing_run_id', 'billing_account_id'])
+
+        # Removing unique constraint on 'BillingRun', fields ['period_start', 'period_end']
+        db.delete_unique('billing_billingrun', ['period_start', 'period_end'])
+
+        # Deleting model 'BillingRun'
+        db.delete_table('billing_billingrun')
+
+        # Deleting model 'Invoice'
+        db.delete_table('billing_invoice')
+
+        # Deleting model 'InvoiceLineItem'
+        db.delete_table('billing_invoicelineitem')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'billing.account': {
+            'Meta': {'object_name': 'Account'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('annoying.fields.AutoOneToOneField', [], {'related_name': "'billing_account'", 'unique': 'True', 'to': "orm['auth.User']"})
+        },
+        'billing.adjustment': {
+            'Meta': {'object_name': 'Adjustment'},
+            'adjustment_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['billing.AdjustmentType']"}),
+            'adjustment_value': ('jsonfield.fields.JSONField', [], {}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'subscription': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['billing.Subscription']"})
+        },
+        'billing.adjustmenttype': {
+            'Meta': {'object_name': 'AdjustmentType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'billing.billingrun': {
+            'Meta': {'unique_together': "(('period_start', 'period_end'),)", 'object_name': 'BillingRun'},
+            'date_completed': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'date_started': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_account_id': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'period_end': ('django.db.models.fields.DateField', [], {}),
+            'period_start': ('django.db.models.fields.DateField', [], {})
+        },
+        'billing.invoice': {
+            'Meta': {'unique_together': "(('billing_run', 'billing_account'),)", 'object_name': 'Invoice'},
+            'billing_account': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoices'", 'to': "orm['billing.Account']"}),
+            'billing_run': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoices'", 'to': "orm['billing.BillingRun']"}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'period_end': ('django.db.models.fields.DateField', [], {}),
+            'period_start': ('django.db.models.fields.DateField', [], {}),
+            'product_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'invoices'", 'to': "orm['billing.ProductType']"}),
+            'total': ('django.db.models.fields.DecimalField', [], {'max_digits': '12', 'decimal_places': '2'})
+        },
+        'billing.invoicelineitem': {
+            'Meta': {'object_name': 'InvoiceLineItem'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'max_digits': '12', 'decimal_places': '2'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'feature': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'invoice': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'line_items'", 'to': "orm['billing.Invoice']"}),
+            'quantity': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'unit_price': ('django.db.models.fields.DecimalField', [], {'max_digits': '12', 'decimal_places': '4'})
+        },
+        'billing.producttype': {
+            'Meta': {'object_name': 'ProductType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'billing.subscription': {
+            'Meta': {'object_name': 'Subscription'},
+            'billing_account': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'subscriptions'", 'to': "orm['billing.Account']"}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'product_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'subscriptions'", 'to': "orm['billing.ProductType']"}),
+            'current_status': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '20', 'blank': 'True'}),
+            'current_status_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'billing.subscriptionapprovalstatus': {
+            'Meta': {'object_name': 'SubscriptionApprovalStatus'},
+            'created': ('model_utils.fields.AutoCreatedField', [], {'default': 'datetime.datetime.now'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modified': ('model_utils.fields.AutoLastModifiedField', [], {'default': 'datetime.datetime.now'}),
+            'note': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'pending'", 'max_length': '20'}),
+            'subscription': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'approval_statuses'", 'to': "orm['billing.Subscription']"})
+        },
+        'billing.usagecounter': {
+            'Meta': {'unique_together': "(('billing_account', 'feature'),)", 'object_name': 'UsageCounter'},
+            'billing_account': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'usage_counters'", 'to': "orm['billing.Account']"}),
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'feature': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['billing']
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, DEFAULT_DB_ALIAS
 from django.db.models import signals
 from django.dispatch import receiver
 from django.conf import settings
@@ -7,9 +7,17 @@ from jsonfield import JSONField
 from model_utils import Choices
 from model_utils.models import TimeStampedModel
 
+import datetime
+
+import billing.adjustments
+import billing.approval
 import billing.loading
+import billing.quotas
+from billing.instrumentation import instrumented
 from billing.processor.utils import router as processor_router
-from billing.signals import ready_for_approval
+from billing.state import BillingState
+from billing.utils import chunked, encode_cursor, decode_cursor,  \
+    encode_bitmap, decode_bitmap, commit_on_success_unless_managed
 
 #BILLING_ACCOUNT = getattr(settings, 'BILLING_ACCOUNT', SimpleAccount)
 
@@ -44,12 +52,99 @@ from billing.signals import ready_for_approval
 
 
 
+# SQLite binds at most 999 parameters per query, so lookups by lists of pks
+# are chunked to keep their IN lists within this (leaving room for a few
+# other parameters)
+MAX_QUERY_PARAMS = 900
+# number of accounts whose current subscriptions are resolved together;
+# get_current_for_accounts() binds two IN lists as long as the chunk
+RESOLVE_CHUNK_SIZE = MAX_QUERY_PARAMS // 2
+
+class AccountQuerySet(models.query.QuerySet):
+    resolve_current_subscriptions = False
+    def with_current_product(self):
+        """
+        resolves the current subscription (and product type) of every
+        account in the queryset in bulk, rather than once per account
+        """
+        qs = self.select_related('owner')
+        qs.resolve_current_subscriptions = True
+        return qs
+    def _clone(self, *args, **kwargs):
+        c = super(AccountQuerySet, self)._clone(*args, **kwargs)
+        c.resolve_current_subscriptions = self.resolve_current_subscriptions
+        return c
+    def iterator(self):
+        accounts = super(AccountQuerySet, self).iterator()
+        if self.resolve_current_subscriptions:
+            accounts = self._iter_with_current_subscriptions(accounts)
+        return accounts
+    def _iter_with_current_subscriptions(self, accounts):
+        cache_name = Subscription._meta.get_field(
+            'billing_account').get_cache_name()
+        for chunk in chunked(accounts, RESOLVE_CHUNK_SIZE):
+            current = Subscription.objects.get_current_for_accounts(chunk)
+            for account in chunk:
+                sub = current.get(account.pk)
+                if sub is not None:
+                    setattr(sub, cache_name, account)
+                account._current_subscription = sub
+                yield account
+
+class AccountManager(models.Manager):
+    def get_query_set(self):
+        return AccountQuerySet(self.model, using=self._db)
+    def with_current_product(self):
+        return self.get_query_set().with_current_product()
+    def add_subscribed_product_type(self, accounts, product_type):
+        """
+        records that each of the given accounts has subscribed to the product
+        type, in their subscribed_product_types bitmaps
+
+        Accounts are updated with one UPDATE per distinct bitmap, each
+        conditional on the bitmap not having changed since it was read, so
+        concurrent subscriptions don't lose each other's bits.
+        """
+        bit = 1 << product_type.pk
+        accounts = dict((a.pk, a) for a in accounts)
+        for chunk in chunked(accounts.keys(), MAX_QUERY_PARAMS):
+            pending = chunk
+            while pending:
+                by_value = {}
+                for pk, value in self.filter(pk__in=pending)  \
+                        .values_list('pk', 'subscribed_product_types'):
+                    if decode_bitmap(value) & bit:
+                        accounts[pk].subscribed_product_types = value
+                    else:
+                        by_value.setdefault(value, []).append(pk)
+                pending = []
+                for value, pks in by_value.items():
+                    new_value = encode_bitmap(decode_bitmap(value) | bit)
+                    updated = self.filter(pk__in=pks,
+                        subscribed_product_types=value,
+                    ).update(subscribed_product_types=new_value)
+                    if updated == len(pks):
+                        for pk in pks:
+                            accounts[pk].subscribed_product_types = new_value
+                    else:
+                        # changed under us; read them again
+                        pending.extend(pks)
+
 class Account(models.Model):
     owner = AutoOneToOneField('auth.User', related_name='billing_account')
+    # the pks of the product types the account has ever subscribed to, as a
+    # hex-encoded bitmap (see AccountManager.add_subscribed_product_type())
+    subscribed_product_types = models.TextField(blank=True, editable=False)
+    objects = AccountManager()
+    @instrumented('account.get_current_subscription')
     def get_current_subscription(self):
-        active_statuses = 'pending', 'approved'
+        try:
+            # already resolved by AccountQuerySet.with_current_product()
+            return self._current_subscription
+        except AttributeError:
+            pass
         active_subs = Subscription.objects.  \
-            filter_by_current_statuses(active_statuses).  \
+            filter_by_current_statuses(ACTIVE_SUBSCIPRTION_STATUSES).  \
             filter(billing_account=self).order_by('-date_created')
         subs = active_subs
         #subs = self.subscriptions.order_by('-date_created')
@@ -58,47 +153,108 @@ class Account(models.Model):
           return r[0]
         return None
     def get_current_product(self):
-        pc = self.get_current_product_class()
+        pc = self.get_current_adjusted_product_class()
         if pc:
             return pc()
-        #sub = self.get_current_subscription()
-        #if sub:
-            #return sub.get_product()
-            #return ()
         return None
+    def get_current_adjusted_product_class(self):
+        """
+        as get_current_product_class(), with the current subscription's
+        adjustments applied
+        """
+        sub = self.get_current_subscription()
+        if sub:
+            return sub.get_adjusted_product_class()
+        return billing.loading.get_default_product()
     def get_current_product_class(self):
         sub = self.get_current_subscription()
         if sub:
             return sub.get_product_class()
-        elif hasattr(settings, 'BILLING_DEFAULT_PRODUCT'):
-            return billing.loading.get_product(settings.BILLING_DEFAULT_PRODUCT)
-        return None
+        return billing.loading.get_default_product()
     def get_processor(self):
         return processor_router.get_processor_for_account(self)
+    @instrumented('processor.has_valid_billing_details')
     def has_valid_billing_details(self):
         return self.get_processor().has_valid_billing_details(self)
+    def can_use(self, feature, n=1):
+        """ returns whether the account may use `n` more units of a feature """
+        return billing.quotas.can_use(self, feature, n)
+    @instrumented('account.subscribe_to_product')
     def subscribe_to_product(self, product):
-        return Subscription.objects.create_from_product(product, self)
+        sub = Subscription.objects.create_from_product(product, self)
+        self.invalidate_billing_state()
+        return sub
+    def get_billing_state(self):
+        """ returns a memoized BillingState snapshot of this account """
+        try:
+            return self._billing_state
+        except AttributeError:
+            self._billing_state = BillingState(self)
+            return self._billing_state
+    def invalidate_billing_state(self):
+        self.__dict__.pop('_billing_state', None)
+        self.__dict__.pop('_current_subscription', None)
+    @instrumented('account.get_visible_products')
     def get_visible_products(self):
-        """ returns the list of products that is visible to the given account """
-        all_products = billing.loading.get_products(hidden=True)
-        public_products = billing.loading.get_products()
-        subscribed_product_types = ProductType.objects  \
-            .filter(subscriptions__billing_account=self)  \
-            .distinct()
-        subscribed_products = set(pt.get_product_class() for pt in subscribed_product_types)
-        visible_products = set(public_products).union(subscribed_products)
-        return [p for p in all_products if p in visible_products]
+        """
+        returns the list of products that is visible to the given account:
+        the public products and any it has subscribed to
+        """
+        return ProductType.objects.get_visible_products(
+            decode_bitmap(self.subscribed_product_types))
     def __unicode__(self):
         return "%s's account" % unicode(self.owner)
     def __repr__(self):
         return "Account(owner=%s)" % repr(self.owner)
 
+class ProductTypeBits(object):
+    """
+    the bit (1 << pk) of each product type in the catalog, and the bits of
+    the public products OR'd together
+    """
+    def __init__(self, catalog, pks):
+        self.catalog = catalog
+        self.bits = []
+        self.known_mask = 0
+        self.public_mask = 0
+        public_products = set(catalog.public_products)
+        for product in catalog.all_products:
+            pk = pks.get(product.name)
+            # products without a product type can't have been subscribed to
+            bit = 0 if pk is None else 1 << pk
+            self.bits.append((product, bit))
+            self.known_mask |= bit
+            if product in public_products:
+                self.public_mask |= bit
+
+_product_type_bits = None
+
 class ProductTypeManager(models.Manager):
     def get_for_product(self, product):
         return self.get(name=product.__name__)
     def get_by_natural_key(self, name):
         return self.get(name=name)
+    def get_bits(self, mask=0):
+        """
+        returns the ProductTypeBits for the current catalog, reloading them if
+        `mask` has bits for product types they don't know about
+        """
+        global _product_type_bits
+        catalog = billing.loading.get_catalog_index()
+        bits = _product_type_bits
+        if bits is None or bits.catalog is not catalog or  \
+                mask & ~bits.known_mask:
+            bits = _product_type_bits = ProductTypeBits(catalog,
+                dict(self.values_list('name', 'pk')))
+        return bits
+    def get_visible_products(self, mask):
+        """
+        returns the public products and those whose product types' bits are
+        set in `mask`, in catalog order
+        """
+        bits = self.get_bits(mask)
+        visible_mask = mask | bits.public_mask
+        return [product for product, bit in bits.bits if bit & visible_mask]
 
 class ProductType(models.Model):
     name = models.CharField(max_length=100)
@@ -112,20 +268,109 @@ class ProductType(models.Model):
     def natural_key(self):
         return (self.name,)
 
+def invalidate_account_caches(*account_ids):
+    """
+    forgets the quota limits and processor routes of the given accounts, both
+    of which may depend on the accounts' current products
+    """
+    billing.quotas.invalidate_limits(*account_ids)
+    processor_router.invalidate(*account_ids)
+
+def get_product_name(product):
+    if isinstance(product, basestring):
+        return product
+    return product.name
+
+# number of rows inserted per query by the bulk subscription methods
+BULK_CHUNK_SIZE = 100
+
 class SubscriptionManager(models.Manager):
     def filter_by_current_statuses(self, statuses):
         """
         returns the subscriptions whose most recent status is
         one of those specified
         """
-        
-        annotated = self.annotate(
-            newest=models.Max('approval_statuses__created'))
-        newest_subs = annotated.filter(
-            approval_statuses__created=models.F('newest'),
-            approval_statuses__status__in=statuses
-        )
-        return newest_subs
+        return self.filter(current_status__in=statuses)
+    def get_current_for_accounts(self, accounts, before=None):
+        """
+        returns a dict mapping the pk of each of the given accounts to its
+        current subscription (with product type loaded), using two queries
+        per RESOLVE_CHUNK_SIZE accounts. With `before`, only subscriptions
+        created before then are considered, giving those in effect at that
+        time.
+
+        Accounts without a current subscription are left out.
+        """
+        accounts = list(accounts)
+        if len(accounts) > RESOLVE_CHUNK_SIZE:
+            current = {}
+            for chunk in chunked(accounts, RESOLVE_CHUNK_SIZE):
+                current.update(self.get_current_for_accounts(chunk, before))
+            return current
+        active = self.filter_by_current_statuses(ACTIVE_SUBSCIPRTION_STATUSES)  \
+            .filter(billing_account__in=[a.pk for a in accounts])
+        if before is not None:
+            active = active.filter(date_created__lt=before)
+        newest = active.order_by().values('billing_account')  \
+            .annotate(newest=models.Max('date_created'))
+        newest = dict((r['billing_account'], r['newest']) for r in newest)
+        candidates = active  \
+            .filter(date_created__in=set(newest.values()))  \
+            .select_related('product_type')  \
+            .order_by('-date_created', '-pk')
+        current = {}
+        for sub in candidates:
+            account_id = sub.billing_account_id
+            if account_id not in current and  \
+                    newest.get(account_id) == sub.date_created:
+                current[account_id] = sub
+        return current
+    def prefetch_adjustments(self, subscriptions):
+        """
+        loads the adjustments of all the given subscriptions, a query per
+        500 subscriptions
+        """
+        subs = dict((sub.pk, sub) for sub in subscriptions)
+        for sub in subs.values():
+            sub._adjustments = []
+        for chunk in chunked(subs.keys(), 500):
+            adjustments = Adjustment.objects  \
+                .filter(subscription__in=chunk)  \
+                .select_related('adjustment_type')  \
+                .order_by('pk')
+            for adjustment in adjustments:
+                subs[adjustment.subscription_id]._adjustments.append(adjustment)
+    def get_history(self, billing_account):
+        """
+        returns the account's subscriptions, newest first, with their
+        product types and approval statuses loaded in two queries
+        """
+        return self.filter(billing_account=billing_account)  \
+            .select_related('product_type')  \
+            .prefetch_related('approval_statuses')  \
+            .order_by('-date_created', '-pk')
+    def get_history_page(self, billing_account, before=None, page_size=20):
+        """
+        returns a (subscriptions, next cursor) pair for a page of the
+        account's subscription history
+
+        Pages are found by seeking to the `before` cursor (as returned for
+        the previous page) rather than by offset, so every page is equally
+        cheap. The next cursor is None on the last page. Raises ValueError
+        for a malformed cursor.
+        """
+        subs = self.get_history(billing_account)
+        if before:
+            date_created, pk = decode_cursor(before)
+            subs = subs.filter(
+                models.Q(date_created__lt=date_created) |
+                models.Q(date_created=date_created, pk__lt=pk))
+        subs = list(subs[:page_size + 1])
+        if len(subs) > page_size:
+            subs = subs[:page_size]
+            last = subs[-1]
+            return subs, encode_cursor(last.date_created, last.pk)
+        return subs, None
     def filter_by_current_status(self, status):
         """
         returns the subscriptions whose most recent status is that specified
@@ -139,13 +384,86 @@ class SubscriptionManager(models.Manager):
     def declined(self):
         return self.filter_by_current_status(status='declined')
     def create_from_product(self, product, billing_account):
-        if isinstance(product, basestring):
-            name = product
-        else:
-            name = product.name
-        pt = ProductType.objects.get(name=name)
+        pt = ProductType.objects.get(name=get_product_name(product))
         sub = self.create(billing_account=billing_account, product_type=pt)
         sub.request_approval()
+        return sub
+    @commit_on_success_unless_managed()
+    def bulk_create_from_product(self, product, billing_accounts):
+        """
+        subscribes each of the given accounts to a product
+
+        The subscriptions and their initial statuses are inserted in bulk and
+        approval is requested for the whole batch at once from the approval
+        backend (see billing.approval). Returns the new subscriptions.
+        """
+        accounts = dict((a.pk, a) for a in billing_accounts)
+        if not accounts:
+            return []
+        # bulk_create() doesn't hand back primary keys, so the inserted rows
+        # are found again as the product's rows after the last pk. Locking
+        # the product type's row serialises bulk subscribes to the product
+        # until this transaction ends, so a concurrent batch's rows can't be
+        # picked up. Both are read from the primary, not a lagging replica
+        # (see billing.replicas)
+        pt = ProductType.objects.using(DEFAULT_DB_ALIAS).select_for_update()  \
+            .get(name=get_product_name(product))
+        now = datetime.datetime.now().replace(microsecond=0)
+        primary = self.using(DEFAULT_DB_ALIAS)
+        last_pk = primary.aggregate(last_pk=models.Max('pk'))['last_pk'] or 0
+        for chunk in chunked(accounts, BULK_CHUNK_SIZE):
+            self.bulk_create([
+                Subscription(billing_account_id=account_id, product_type=pt,
+                    current_status=Subscription.APPROVAL_STATUS.pending,
+                    current_status_date=now)
+                for account_id in chunk
+            ])
+        new_subs = primary.filter(pk__gt=last_pk, product_type=pt,
+            current_status_date=now).order_by('pk')
+        cache_name = Subscription._meta.get_field(
+            'billing_account').get_cache_name()
+        subs = []
+        for sub in new_subs.iterator():
+            if sub.billing_account_id in accounts:
+                sub.product_type = pt
+                setattr(sub, cache_name, accounts[sub.billing_account_id])
+                subs.append(sub)
+        for chunk in chunked(subs, BULK_CHUNK_SIZE):
+            SubscriptionApprovalStatus.objects.bulk_create([
+                SubscriptionApprovalStatus(subscription_id=sub.pk,
+                    status=SubscriptionApprovalStatus.STATUS.pending,
+                    created=now, modified=now)
+                for sub in chunk
+            ])
+        Account.objects.add_subscribed_product_type(accounts.values(), pt)
+        for account in accounts.values():
+            account.invalidate_billing_state()
+        invalidate_account_caches(*accounts.keys())
+        billing.approval.get_backend().request_approval(subs)
+        return subs
+    def bulk_set_current_approval_status(self, subscriptions, status, note=''):
+        """ records the same new status for each of the given subscriptions """
+        if status not in zip(*Subscription.APPROVAL_STATUS)[1]:
+            raise ValueError('"%s" is not a valid status' % status)
+        now = datetime.datetime.now()
+        cache_name = Subscription._meta.get_field(
+            'billing_account').get_cache_name()
+        for chunk in chunked(subscriptions, BULK_CHUNK_SIZE):
+            SubscriptionApprovalStatus.objects.bulk_create([
+                SubscriptionApprovalStatus(subscription_id=sub.pk,
+                    status=status, note=note, created=now, modified=now)
+                for sub in chunk
+            ])
+            self.filter(pk__in=[sub.pk for sub in chunk]).update(
+                current_status=status, current_status_date=now)
+            for sub in chunk:
+                sub.current_status = status
+                sub.current_status_date = now
+                account = getattr(sub, cache_name, None)
+                if account is not None:
+                    account.invalidate_billing_state()
+            invalidate_account_caches(
+                *set(sub.billing_account_id for sub in chunk))
 
 ACTIVE_SUBSCIPRTION_STATUSES = getattr(settings,
     'BILLING_ACTIVE_SUBSCIPRTION_STATUSES', ('pending', 'approved'))  
@@ -157,30 +475,53 @@ class Subscription(models.Model):
     product_type = models.ForeignKey(
         ProductType, related_name='subscriptions')
     date_created = models.DateTimeField(auto_now_add=True)
+    # denormalized copy of the newest SubscriptionApprovalStatus, kept up to
+    # date by update_subscription_current_status()
+    current_status = models.CharField(choices=APPROVAL_STATUS,
+        max_length=20, blank=True, db_index=True, editable=False)
+    current_status_date = models.DateTimeField(
+        null=True, blank=True, editable=False)
     def get_product(self):
-        unadjusted_product = self.product_type.get_product_class()
-        # this should apply adjustments
-        adjustments = Adjustment.objects.filter(subscription=self)
-        return unadjusted_product()
+        """ returns an instance of the subscription's adjusted product """
+        return self.get_adjusted_product_class()()
     def get_product_class(self):
         return self.product_type.get_product_class()
+    def get_adjustments(self):
+        """
+        returns the subscription's adjustments (with their types), in the
+        order they apply
+        """
+        try:
+            return self._adjustments
+        except AttributeError:
+            self._adjustments = list(self.adjustment_set  \
+                .select_related('adjustment_type').order_by('pk'))
+            return self._adjustments
+    def get_adjusted_product_class(self):
+        """ returns the product class with the adjustments applied """
+        return billing.adjustments.get_adjusted_product_class(
+            self.get_product_class(),
+            [(a.adjustment_type.name, a.adjustment_value)
+                for a in self.get_adjustments()])
     def get_current_approval_status(self):
-        statuses = self.approval_statuses.order_by('-created')
-        r = list(statuses[:1])
-        if r:
-          return r[0].status
-        return None
+        return self.current_status or None
     def set_current_approval_status(self, status, note=''):
+        """
+        records a new status for the subscription; the status row and the
+        subscription's copy of it are written in one transaction (the
+        caller's, if it is managing one)
+        """
         # Choices is a tuple: (db rep, py identifier, human readable)
         if status not in zip(*self.APPROVAL_STATUS)[1]:
             raise ValueError('"%s" is not a valid status' % status)
-        SubscriptionApprovalStatus.objects.create(
-            status=status, subscription=self, note=note)
+        with commit_on_success_unless_managed():
+            SubscriptionApprovalStatus.objects.create(
+                status=status, subscription=self, note=note)
     def is_active(self):
         cur_stat = self.get_current_approval_status()
         return cur_stat in ACTIVE_SUBSCIPRTION_STATUSES
     def request_approval(self):
-        ready_for_approval.send(sender=self)
+        billing.approval.get_backend().request_approval([self])
     def __unicode__(self):
         return '%s (%s)' % (self.product_type.name, self.get_current_approval_status())
     def __repr__(self):
@@ -190,6 +531,8 @@ class Subscription(models.Model):
 def auto_add_subscription_approval_status(instance, created, **kwargs):
     if created:
         instance.set_current_approval_status('pending')
+        Account.objects.add_subscribed_product_type(
+            [instance.billing_account], instance.product_type)
         #SubscriptionApprovalStatus.objects.create(subscription=instance)
         
 
@@ -205,11 +548,153 @@ class SubscriptionApprovalStatus(TimeStampedModel):
     def __repr__(self):
         return self.__unicode__()
 
+@receiver(signals.post_save, sender=SubscriptionApprovalStatus)
+def update_subscription_current_status(instance, created, **kwargs):
+    """ copies a newly created status onto its subscription """
+    if not created:
+        return
+    subs = Subscription.objects.filter(pk=instance.subscription_id)
+    subs.update(
+        current_status=instance.status,
+        current_status_date=instance.created,
+    )
+    # the account's current product (and so its quotas) may have changed, and
+    # an already-loaded subscription instance should be kept in sync as well
+    cache_name = SubscriptionApprovalStatus._meta.get_field(
+        'subscription').get_cache_name()
+    sub = getattr(instance, cache_name, None)
+    if sub is None:
+        invalidate_account_caches(
+            *subs.values_list('billing_account', flat=True))
+    else:
+        invalidate_account_caches(sub.billing_account_id)
+        sub.current_status = instance.status
+        sub.current_status_date = instance.created
+        cache_name = Subscription._meta.get_field(
+            'billing_account').get_cache_name()
+        account = getattr(sub, cache_name, None)
+        if account is not None:
+            account.invalidate_billing_state()
+
 class AdjustmentType(models.Model):
+    # the name of an adjustment class (see billing.adjustments)
+    name = models.CharField(max_length=100, unique=True)
     def adjustment_class(self):
-        pass
+        return billing.loading.get_adjustment(self.name)
+    def __unicode__(self):
+        return self.name
 
 class Adjustment(models.Model):
     adjustment_type = models.ForeignKey(AdjustmentType)
     adjustment_value = JSONField()
     subscription = models.ForeignKey(Subscription)
+    def __repr__(self):
+        return 'Adjustment(type=%s, value=%r)' % (self.adjustment_type.name, self.adjustment_value)
+
+@receiver(signals.post_save, sender=Adjustment)
+@receiver(signals.post_delete, sender=Adjustment)
+def invalidate_adjusted_account(instance, **kwargs):
+    """ an account's quota limits may depend on its adjustments """
+    invalidate_account_caches(*Subscription.objects  \
+        .filter(pk=instance.subscription_id)  \
+        .values_list('billing_account', flat=True))
+    cache_name = Adjustment._meta.get_field('subscription').get_cache_name()
+    sub = getattr(instance, cache_name, None)
+    if sub is not None:
+        sub.__dict__.pop('_adjustments', None)
+
+class UsageCounter(models.Model):
+    """
+    the number of units of a feature an account is using
+
+    Maintained by billing.usage for registered models
+    """
+    billing_account = models.ForeignKey(Account, related_name='usage_counters')
+    feature = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+    class Meta:
+        unique_together = ('billing_account', 'feature')
+    def __unicode__(self):
+        return '%s: %s' % (self.feature, self.count)
+    def __repr__(self):
+        return 'UsageCounter(feature=%s, count=%s)' % (self.feature, self.count)
+
+class BillingRun(models.Model):
+    """
+    an invoicing pass over every account for one billing period
+
+    `last_account_id` checkpoints the run, so an interrupted run picks up
+    where it left off (see billing.invoicing.run_billing)
+    """
+    period_start = models.DateField()
+    period_end = models.DateField()
+    last_account_id = models.IntegerField(default=0)
+    date_started = models.DateTimeField(auto_now_add=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+    class Meta:
+        unique_together = ('period_start', 'period_end')
+    def __unicode__(self):
+        return 'BillingRun(%s - %s)' % (self.period_start, self.period_end)
+    def __repr__(self):
+        return self.__unicode__()
+
+class Invoice(models.Model):
+    billing_run = models.ForeignKey(BillingRun, related_name='invoices')
+    billing_account = models.ForeignKey(Account, related_name='invoices')
+    product_type = models.ForeignKey(ProductType, related_name='invoices')
+    period_start = models.DateField()
+    period_end = models.DateField()
+    total = models.DecimalField(max_digits=12, decimal_places=2)
+    date_created = models.DateTimeField(auto_now_add=True)
+    class Meta:
+        unique_together = ('billing_run', 'billing_account')
+    def __unicode__(self):
+        return 'Invoice(account=%s, total=%s)' % (self.billing_account_id, self.total)
+    def __repr__(self):
+        return self.__unicode__()
+
+class InvoiceLineItem(models.Model):
+    invoice = models.ForeignKey(Invoice, related_name='line_items')
+    description = models.CharField(max_length=200)
+    feature = models.CharField(max_length=100, blank=True)
+    quantity = models.IntegerField(default=1)
+    unit_price = models.DecimalField(max_digits=12, decimal_places=4)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    def __unicode__(self):
+        return '%s: %s' % (self.description, self.amount)
+    def __repr__(self):
+        return 'InvoiceLineItem(description=%s, amount=%s)' % (self.description, self.amount)
+
+class ApprovalJob(models.Model):
+    """
+    a subscription waiting for approval by a worker (see billing.approval).
+    Jobs are deleted once their subscription's approval has been requested
+    """
+    STATUS = Choices('queued', 'claimed', 'failed')
+    subscription = models.ForeignKey(Subscription, related_name='approval_jobs')
+    status = models.CharField(choices=STATUS, default=STATUS.queued,
+        max_length=20, db_index=True)
+    claim_token = models.CharField(max_length=32, blank=True, db_index=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_claimed = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # failed jobs are retried with a backoff, not before this time
+    not_before = models.DateTimeField(null=True, blank=True)
+    def __repr__(self):
+        return 'ApprovalJob(subscription=%s, status=%s)' % (self.subscription_id, self.status)
+
+class ArchivedApprovalStatus(models.Model):
+    """
+    a SubscriptionApprovalStatus moved out of the (hot) status table by the
+    compact_approval_statuses command (see billing.archiving)
+    """
+    original_id = models.IntegerField(unique=True)
+    subscription = models.ForeignKey(
+        Subscription, related_name='archived_approval_statuses')
+    status = models.CharField(
+        choices=Subscription.APPROVAL_STATUS, max_length=20)
+    note = models.TextField(blank=True)
+    created = models.DateTimeField()
+    def __repr__(self):
+        return 'ArchivedApprovalStatus(subscription=%s, status=%s)' % (self.subscription_id, self.status)
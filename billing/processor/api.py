@@ -1,6 +1,103 @@
+from functools import wraps
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+BILLING_DETAILS_CACHE_TIMEOUT = getattr(settings,
+    'BILLING_DETAILS_CACHE_TIMEOUT', 60 * 60 * 24)
 
 class BillingProcessor(object):
     def get_billing_details_form(self, billing_account):
         return self.billing_details_form
     def has_valid_billing_details(self):
         raise NotImplementedError('has_valid_billing_details() must be over-ridden by subclasses')
+    @classmethod
+    def has_valid_billing_details_many(cls, accounts):
+        """
+        returns a dict mapping the pk of each of the given accounts to
+        whether it has valid billing details
+
+        Checks each account in turn; processors which can check many
+        accounts at once (e.g. with a single query) should override this.
+        """
+        return dict((a.pk, cls.has_valid_billing_details(a)) for a in accounts)
+    @classmethod
+    def has_valid_billing_details_concurrently(cls, accounts, max_workers=10):
+        """
+        as has_valid_billing_details_many(), but checks up to `max_workers`
+        accounts at a time from a pool of threads
+
+        Useful for processors which have to call out to a remote gateway
+        for each account, so the total time is bounded by the concurrency
+        rather than the sum of the round trips.
+        """
+        accounts = list(accounts)
+        if not accounts:
+            return {}
+        check = cls.has_valid_billing_details
+        workers = min(max_workers, len(accounts))
+        def check_share(share):
+            try:
+                return [(a.pk, check(a)) for a in share]
+            finally:
+                # the worker thread's connections would otherwise never be
+                # closed; close them once, when its share is done
+                for conn in connections.all():
+                    conn.close()
+        shares = [accounts[i::workers] for i in range(workers)]
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(check_share, shares)
+        finally:
+            pool.close()
+            pool.join()
+        valid = {}
+        for share_results in results:
+            valid.update(share_results)
+        return valid
+
+class BillingDetailsCache(object):
+    """
+    caches whether each account has valid billing details in Django's cache
+
+    Decorate a processor's has_valid_billing_details(account) function with
+    `cached` (and its has_valid_billing_details_many(accounts) function with
+    `cached_many`). Processors which store billing details locally should
+    call invalidate() whenever they change; processors backed by a remote
+    gateway, which can't tell when details change, should instead pass a
+    short `timeout` so results simply expire.
+    """
+    def __init__(self, key_prefix, timeout=BILLING_DETAILS_CACHE_TIMEOUT):
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+    def get_key(self, account_id):
+        return 'billing:details:%s:%s' % (self.key_prefix, account_id)
+    def invalidate(self, account_id):
+        cache.delete(self.get_key(account_id))
+    def cached(self, func):
+        @wraps(func)
+        def wrapper(account):
+            key = self.get_key(account.pk)
+            valid = cache.get(key)
+            if valid is None:
+                valid = bool(func(account))
+                cache.set(key, valid, self.timeout)
+            return valid
+        return wrapper
+    def cached_many(self, func):
+        @wraps(func)
+        def wrapper(accounts):
+            accounts = list(accounts)
+            keys = dict((self.get_key(a.pk), a.pk) for a in accounts)
+            valid = dict((keys[key], v)
+                for key, v in cache.get_many(keys.keys()).items())
+            missing = [a for a in accounts if a.pk not in valid]
+            if missing:
+                fresh = func(missing)
+                cache.set_many(dict((self.get_key(pk), v)
+                    for pk, v in fresh.items()), self.timeout)
+                valid.update(fresh)
+            return valid
+        return wrapper
@@ -0,0 +1,104 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    depends_on = (
+        ('billing', '0001_initial'),
+    )
+
+    def forwards(self, orm):
+        
+        # deployments from before this app had migrations already have its
+        # tables (created by syncdb), so only create the missing ones
+        from django.db import connections
+        tables = connections[db.db_alias].introspection.table_names()
+
+        # Adding model 'IOUAccount'
+        if 'simple_account_iouaccount' not in tables:
+            db.create_table('simple_account_iouaccount', (
+                ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+                ('billing_account', self.gf('django.db.models.fields.related.OneToOneField')(related_name='simple_processor_iou_account', unique=True, to=orm['billing.Account'])),
+            ))
+            db.send_create_signal('simple_account', ['IOUAccount'])
+
+        # Adding model 'AccountIOU'
+        if 'simple_account_accountiou' not in tables:
+            db.create_table('simple_account_accountiou', (
+                ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+                ('iou_account', self.gf('django.db.models.fields.related.ForeignKey')(related_name='simple_processor_ious', to=orm['simple_account.IOUAccount'])),
+                ('has_agreed_to_pay', self.gf('django.db.models.fields.BooleanField')(default=False)),
+                ('created', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ))
+            db.send_create_signal('simple_account', ['AccountIOU'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'IOUAccount'
+        db.delete_table('simple_account_iouaccount')
+
+        # Deleting model 'AccountIOU'
+        db.delete_table('simple_account_accountiou')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'billing.account': {
+            'Meta': {'object_name': 'Account'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('annoying.fields.AutoOneToOneField', [], {'related_name': "'billing_account'", 'unique': 'True', 'to': "orm['auth.User']"})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'simple_account.accountiou': {
+            'Meta': {'ordering': "['-created']", 'object_name': 'AccountIOU'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'has_agreed_to_pay': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'iou_account': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'simple_processor_ious'", 'to': "orm['simple_account.IOUAccount']"})
+        },
+        'simple_account.iouaccount': {
+            'Meta': {'object_name': 'IOUAccount'},
+            'billing_account': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'simple_processor_iou_account'", 'unique': 'True', 'to': "orm['billing.Account']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'})
+        }
+    }
+
+    complete_apps = ['simple_account']
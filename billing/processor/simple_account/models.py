@@ -1,14 +1,22 @@
 
 from django.db import models
+from django.db.models import signals
 from django.dispatch import receiver
 
-from billing.signals import ready_for_approval
+from billing.processor.api import BillingDetailsCache
+from billing.signals import ready_for_approval, batch_ready_for_approval
+from billing.utils import chunked
 
 # account-based immutable processor
 
 class IOUAccount(models.Model):
     billing_account = models.OneToOneField(
         'billing.Account', related_name='simple_processor_iou_account')
+    # denormalized copy of the newest AccountIOU, kept up to date by
+    # update_iou_account_latest_iou()
+    has_agreed_to_pay = models.BooleanField(default=False, editable=False)
+    latest_iou_created = models.DateTimeField(
+        null=True, blank=True, editable=False)
 
 class AccountIOU(models.Model):
     iou_account = models.ForeignKey(
@@ -22,12 +30,74 @@ class AccountIOU(models.Model):
         return 'AccountIOU(has_agreed_to_pay=%s)' % self.has_agreed_to_pay
     
 
+details_cache = BillingDetailsCache('simple_account')
+
+@receiver(signals.post_save, sender=IOUAccount)
+@receiver(signals.post_delete, sender=IOUAccount)
+def invalidate_iou_account(instance, **kwargs):
+    details_cache.invalidate(instance.billing_account_id)
+
+@receiver(signals.post_save, sender=AccountIOU)
+def update_iou_account_latest_iou(instance, created, **kwargs):
+    """ copies a newly created IOU onto its IOU account """
+    if not created:
+        return
+    IOUAccount.objects.filter(
+        models.Q(latest_iou_created__isnull=True) |
+        models.Q(latest_iou_created__lte=instance.created),
+        pk=instance.iou_account_id,
+    ).update(
+        has_agreed_to_pay=instance.has_agreed_to_pay,
+        latest_iou_created=instance.created,
+    )
+    # keep an already-loaded IOU account in sync as well
+    cache_name = AccountIOU._meta.get_field('iou_account').get_cache_name()
+    iou_account = getattr(instance, cache_name, None)
+    if iou_account is not None:
+        iou_account.has_agreed_to_pay = instance.has_agreed_to_pay
+        iou_account.latest_iou_created = instance.created
+
+@receiver(signals.post_save, sender=AccountIOU)
+@receiver(signals.post_delete, sender=AccountIOU)
+def invalidate_account_iou(instance, **kwargs):
+    cache_name = AccountIOU._meta.get_field('iou_account').get_cache_name()
+    iou_account = getattr(instance, cache_name, None)
+    if iou_account is not None:
+        account_id = iou_account.billing_account_id
+    else:
+        # in a cascading delete the IOU account may already be gone, in
+        # which case its own post_delete receiver invalidates the account
+        account_ids = IOUAccount.objects.filter(pk=instance.iou_account_id)  \
+            .values_list('billing_account', flat=True)
+        if not account_ids:
+            return
+        account_id = account_ids[0]
+    details_cache.invalidate(account_id)
+
+@details_cache.cached
 def has_valid_billing_details(account):
-    try:
-        iou_account = account.simple_processor_iou_account
-    except IOUAccount.DoesNotExist:
-        return False
-    return iou_account.simple_processor_ious.latest().has_agreed_to_pay
+    # queried afresh rather than through the account's cached IOU account,
+    # which update_iou_account_latest_iou() doesn't keep up to date
+    agreed = IOUAccount.objects.filter(billing_account=account.pk)  \
+        .values_list('has_agreed_to_pay', flat=True)
+    agreed = list(agreed[:1])
+    return bool(agreed) and agreed[0]
+
+@details_cache.cached_many
+def has_valid_billing_details_many(accounts):
+    """
+    returns a dict mapping the pk of each of the given accounts to whether
+    it has valid billing details, using one query per 500 accounts
+    """
+    valid = {}
+    for chunk in chunked([a.pk for a in accounts], 500):
+        iou_accounts = IOUAccount.objects  \
+            .filter(billing_account__in=chunk)  \
+            .values_list('billing_account', 'has_agreed_to_pay')
+        valid.update(iou_accounts)
+        for account_id in chunk:
+            valid.setdefault(account_id, False)
+    return valid
 
 @receiver(ready_for_approval)
 def do_subscription_approval(sender, **kwargs):
@@ -39,3 +109,18 @@ def do_subscription_approval(sender, **kwargs):
         status = 'declined'
     sender.set_current_approval_status(status)
     return status
+
+@receiver(batch_ready_for_approval)
+def do_batch_subscription_approval(sender, subscriptions, **kwargs):
+    """ `sender` is the Subscription model; approves the batch at once """
+    req_payment = [sub for sub in subscriptions
+        if sub.get_product_class().get_requires_payment_details()]
+    valid = has_valid_billing_details_many(
+        [sub.billing_account for sub in req_payment])
+    declined = [sub for sub in req_payment
+        if not valid[sub.billing_account_id]]
+    declined_pks = set(sub.pk for sub in declined)
+    approved = [sub for sub in subscriptions if sub.pk not in declined_pks]
+    sender.objects.bulk_set_current_approval_status(approved, 'approved')
+    sender.objects.bulk_set_current_approval_status(declined, 'declined')
+    return True
@@ -3,9 +3,11 @@ from billing.processor.api import BillingProcessor
 
 from billing.processor.simple_account.forms import get_billing_details_form
 from billing.processor.simple_account.models import has_valid_billing_details
+from billing.processor.simple_account.models import has_valid_billing_details_many
 
 class SimpleAccountBillingProcessor(BillingProcessor):
     has_valid_billing_details = staticmethod(has_valid_billing_details)
+    has_valid_billing_details_many = staticmethod(has_valid_billing_details_many)
     get_billing_details_form = staticmethod(get_billing_details_form)
 
 
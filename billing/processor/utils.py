@@ -1,8 +1,12 @@
+import threading
+
 from django.conf import settings
 
+from billing.instrumentation import instrumented
 from billing.loading import get_processor, import_item
+from billing.utils import LRUCache
 
-__all__ = ('router',)
+__all__ = ('router', 'has_valid_billing_details_many')
 
 class BaseProcessorRouter(object):
     def get_processor_for_account(self, account):
@@ -10,14 +14,59 @@ class BaseProcessorRouter(object):
             'get_processor_for_account() should be implemented by subclass')
 
 class MasterProcessorRouter(BaseProcessorRouter):
-    def __init__(self, router_list):
-        self.routers = []
-        for pr in BILLING_PROCESSOR_ROUTERS:
-            routers.append(import_item(pr))
+    """
+    asks each of the configured routers, in turn, which processor to use for
+    an account. Routers are imported and instantiated on first use and each
+    account's route is remembered until it is invalidated
+    """
+    def __init__(self, router_list, cache_size=10000):
+        self.router_list = router_list
+        self._routers = None
+        self._lock = threading.Lock()
+        self.route_cache = LRUCache(cache_size)
+    @property
+    def routers(self):
+        if self._routers is None:
+            with self._lock:
+                if self._routers is None:
+                    routers = []
+                    for pr in self.router_list:
+                        if isinstance(pr, basestring):
+                            pr = import_item(pr)
+                        if isinstance(pr, type):
+                            pr = pr()
+                        routers.append(pr)
+                    self._routers = routers
+        return self._routers
     def get_processor_for_account(self, account):
         return get_processor(self.get_processor_name_for_account(account))
+    @instrumented('router.get_processor_name_for_account')
     def get_processor_name_for_account(self, account):
-        chosen_processor = None
+        if account.pk is None:
+            return self._route(account)
+        name = self.route_cache.get(account.pk)
+        if name is None:
+            name = self._route(account)
+            self.route_cache.set(account.pk, name)
+        return name
+    def get_processor_names_for_accounts(self, accounts):
+        """
+        returns a dict mapping the name of each processor used by any of the
+        given accounts to the list of those accounts it is used for
+        """
+        by_processor = {}
+        for account in accounts:
+            name = self.get_processor_name_for_account(account)
+            by_processor.setdefault(name, []).append(account)
+        return by_processor
+    def invalidate(self, *account_ids):
+        """ forgets the routes of the given accounts """
+        for account_id in account_ids:
+            self.route_cache.pop(account_id)
+    def clear(self):
+        """ forgets all routes, e.g. after changing the router list """
+        self.route_cache.clear()
+    def _route(self, account):
         for router in self.routers:
             try:
                 method = router.get_processor_for_account
@@ -32,5 +81,22 @@ class MasterProcessorRouter(BaseProcessorRouter):
 
 # load the billing processor routers
 BILLING_PROCESSOR_ROUTERS = getattr(settings, 'BILLING_PROCESSOR_ROUTERS', ())
+BILLING_PROCESSOR_ROUTE_CACHE_SIZE = getattr(settings,
+    'BILLING_PROCESSOR_ROUTE_CACHE_SIZE', 10000)
+
+router = MasterProcessorRouter(
+    BILLING_PROCESSOR_ROUTERS, BILLING_PROCESSOR_ROUTE_CACHE_SIZE)
 
-router = MasterProcessorRouter(BILLING_PROCESSOR_ROUTERS)
+@instrumented('processor.has_valid_billing_details_many')
+def has_valid_billing_details_many(accounts):
+    """
+    returns a dict mapping the pk of each of the given accounts to whether
+    it has valid billing details, asking each processor about all of its
+    accounts at once
+    """
+    by_processor = router.get_processor_names_for_accounts(accounts)
+    valid = {}
+    for name, processor_accounts in by_processor.items():
+        processor = get_processor(name)
+        valid.update(processor.has_valid_billing_details_many(processor_accounts))
+    return valid
@@ -0,0 +1,143 @@
+"""
+Cache-backed quota enforcement
+
+An account's limits (the units included by its product's FixedInclusion
+pricing schemes) and its current usage of each feature are kept in Django's
+cache, so checking a quota doesn't need to resolve the account's product or
+count anything:
+
+    if account.can_use('Projects'):
+        ...
+
+    @quota_required('ApiCalls', consume=True)
+    def api_view(request):
+        ...
+
+Usage is seeded from, and written back to, the account's UsageCounter (see
+billing.usage), so it survives cache evictions. For features counted by a
+model registered with billing.usage, just check can_use() before creating
+the object; the counter (and the cached usage) goes up when it is saved.
+reserve() is for features with no such model, such as API calls.
+"""
+
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+
+import billing.usage
+from billing.features import get_inclusion_limits
+
+QUOTA_CACHE_TIMEOUT = getattr(settings, 'BILLING_QUOTA_CACHE_TIMEOUT', 3600)
+
+def _limits_key(account_id):
+    return 'billing:quota:limits:%s' % account_id
+
+def _usage_key(account_id, feature):
+    return 'billing:quota:usage:%s:%s' % (account_id, feature)
+
+def get_limits(account):
+    """
+    returns a dict mapping feature names to the number of units the
+    account's current product includes
+    """
+    key = _limits_key(account.pk)
+    limits = cache.get(key)
+    if limits is None:
+        product_class = account.get_current_adjusted_product_class()
+        limits = get_inclusion_limits(product_class) if product_class else {}
+        cache.set(key, limits, QUOTA_CACHE_TIMEOUT)
+    return limits
+
+def get_limit(account, feature):
+    """ returns the account's limit for the feature (None if unlimited) """
+    return get_limits(account).get(billing.usage.get_feature_name(feature))
+
+def get_usage(account, feature):
+    """ returns the number of units of the feature the account is using """
+    feature = billing.usage.get_feature_name(feature)
+    key = _usage_key(account.pk, feature)
+    usage = cache.get(key)
+    if usage is None:
+        usage = billing.usage.get_usage(account, feature)
+        cache.add(key, usage, QUOTA_CACHE_TIMEOUT)
+    return usage
+
+def can_use(account, feature, n=1):
+    """ returns whether the account may use `n` more units of the feature """
+    limit = get_limit(account, feature)
+    if limit is None:
+        return True
+    return get_usage(account, feature) + n <= limit
+
+def reserve(account, feature, n=1):
+    """
+    takes `n` units of the feature for the account, if that keeps it
+    within its limit. Returns whether the units were taken.
+    """
+    feature = billing.usage.get_feature_name(feature)
+    limit = get_limit(account, feature)
+    if limit is not None:
+        key = _usage_key(account.pk, feature)
+        get_usage(account, feature)  # make sure the usage is cached
+        try:
+            usage = cache.incr(key, n)
+        except ValueError:
+            # evicted since it was cached; take the units with a conditional
+            # update of the counter instead, so concurrent reservations
+            # can't both pass the limit, and re-cache the usage from it
+            if not billing.usage.increment_within(account, feature, limit, n):
+                return False
+            cache.delete(key)
+        else:
+            if usage > limit:
+                cache.decr(key, n)
+                return False
+            billing.usage.increment(account, feature, n, update_cache=False)
+    else:
+        billing.usage.increment(account, feature, n)
+    return True
+
+def release(account, feature, n=1):
+    """ gives back `n` previously reserved units of the feature """
+    billing.usage.increment(account, feature, -n)
+
+def usage_changed(account_id, feature, n):
+    """ applies a change recorded in the database to the cached usage """
+    try:
+        cache.incr(_usage_key(account_id, feature), n)
+    except ValueError:
+        pass  # not cached; will be read from the database when needed
+
+def usage_reset(account_ids, feature):
+    """
+    forgets the cached usage of the feature for the given accounts, e.g.
+    after their counters were recounted
+    """
+    cache.delete_many([_usage_key(account_id, feature)
+        for account_id in account_ids])
+
+def invalidate_limits(*account_ids):
+    """ forgets the cached limits of the given accounts """
+    cache.delete_many([_limits_key(account_id) for account_id in account_ids])
+
+def quota_required(feature, n=1, consume=False):
+    """
+    view decorator which raises PermissionDenied if the requesting user's
+    account can't use `n` more units of `feature`. With `consume`, the units
+    are also reserved.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            account = request.user.billing_account
+            if consume:
+                allowed = reserve(account, feature, n)
+            else:
+                allowed = can_use(account, feature, n)
+            if not allowed:
+                raise PermissionDenied
+            return view_func(request, *args, **kwargs)
+        return _wrapped_view
+    return decorator
@@ -0,0 +1,137 @@
+"""
+Read replicas for billing reads
+
+BillingReplicaRouter sends reads of the billing models (current
+subscriptions, visible products, history, admin listings, ...) to the
+databases named by the BILLING_REPLICA_DATABASES setting, and their writes
+to the default database:
+
+    DATABASE_ROUTERS = ['billing.replicas.BillingReplicaRouter']
+    BILLING_REPLICA_DATABASES = ['replica']
+
+Replicas lag behind the primary, so reads have to see the thread's own
+writes: as soon as a thread writes to a billing model (e.g. by subscribing
+to a product or changing a subscription's approval status) its billing
+reads are pinned to the primary. BillingReplicaMiddleware extends this to
+the rest of the session, for BILLING_REPLICA_PIN_SECONDS, so the pages a
+user sees after subscribing are read from the primary too. Put it after
+SessionMiddleware:
+
+    MIDDLEWARE_CLASSES = (
+        ...
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'billing.replicas.BillingReplicaMiddleware',
+        ...
+    )
+
+Outside of requests nothing clears the pin: worker threads and management
+commands stay pinned to the primary once they have written, until they call
+unpin() (e.g. between the units of work of a long-running loop).
+
+Code that reads rows back right after inserting them (e.g. to find the pks
+bulk_create() doesn't return) should read from DEFAULT_DB_ALIAS explicitly,
+since the reads before its first write aren't pinned.
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_APPS = getattr(settings, 'BILLING_REPLICA_APPS',
+    ('billing', 'simple_account'))
+# how long a session's billing reads stay on the primary after it writes;
+# this should comfortably exceed the replicas' lag
+REPLICA_PIN_SECONDS = getattr(settings, 'BILLING_REPLICA_PIN_SECONDS', 15)
+SESSION_KEY = '_billing_pinned_until'
+
+_local = threading.local()
+
+def get_replicas():
+    """ returns the aliases of the configured replica databases """
+    return getattr(settings, 'BILLING_REPLICA_DATABASES', ())
+
+def pin():
+    """ sends this thread's billing reads to the primary until unpin() """
+    _local.pinned = True
+
+def unpin():
+    """ lets this thread's billing reads go to a replica again """
+    _local.pinned = False
+    _local.written = False
+    _local.replica = None
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+def has_written():
+    """ whether this thread has written to a billing model since unpin() """
+    return getattr(_local, 'written', False)
+
+
+class BillingReplicaRouter(object):
+    """
+    routes reads of billing models to a replica, unless the thread is pinned
+    to the primary, and their writes to the primary
+
+    Only BillingReplicaMiddleware clears a thread's pin; elsewhere a thread
+    which has written reads from the primary until it calls unpin().
+    """
+    def is_billing_model(self, model):
+        return model._meta.app_label in REPLICA_APPS
+    def db_for_read(self, model, **hints):
+        if not self.is_billing_model(model):
+            return None
+        replicas = get_replicas()
+        if not replicas:
+            return None
+        if is_pinned():
+            # explicitly, since the instance hint may come from a replica
+            return DEFAULT_DB_ALIAS
+        # stick to one replica, so the thread's reads don't go back in time
+        replica = getattr(_local, 'replica', None)
+        if replica not in replicas:
+            replica = _local.replica = random.choice(replicas)
+        return replica
+    def db_for_write(self, model, **hints):
+        if self.is_billing_model(model):
+            _local.written = True
+            pin()
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db in get_replicas():
+            # e.g. the owner of an account read from a replica
+            return DEFAULT_DB_ALIAS
+        return None
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set(get_replicas())
+        databases.add(DEFAULT_DB_ALIAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+    def allow_syncdb(self, db, model):
+        if db in get_replicas():
+            # replicas get their tables from the primary
+            return False
+        return None
+
+
+class BillingReplicaMiddleware(object):
+    """
+    pins the billing reads of a session to the primary for
+    REPLICA_PIN_SECONDS after any request in it writes to a billing model
+    """
+    def process_request(self, request):
+        unpin()
+        session = getattr(request, 'session', None)
+        if get_replicas() and session is not None  \
+                and session.get(SESSION_KEY, 0) > time.time():
+            pin()
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        if has_written() and get_replicas() and session is not None:
+            session[SESSION_KEY] = time.time() + REPLICA_PIN_SECONDS
+        unpin()
+        return response
@@ -1,3 +1,12 @@
 from django.dispatch import Signal
 
 ready_for_approval = Signal(providing_args=[])
+
+# sent with a list of newly created subscriptions, so processors can approve
+# them all at once. Receivers which handle the batch should return a true
+# value; otherwise ready_for_approval is sent for each subscription in turn.
+batch_ready_for_approval = Signal(providing_args=['subscriptions'])
+
+# sent by billing.instrumentation (when enabled) after each instrumented
+# operation, with its wall time in seconds and the number of queries it ran
+operation_timed = Signal(providing_args=['operation', 'seconds', 'queries'])
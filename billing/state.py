@@ -0,0 +1,44 @@
+import billing.loading
+
+class BillingState(object):
+    """
+    A memoized snapshot of an account's billing state
+
+    Each value is computed on first access and then reused, so a request
+    which consults the state several times (the subscription dispatcher,
+    the overview page and the `product_change_type` filter) only queries
+    for it once. The snapshot hangs off the Account instance, which Django
+    caches on `request.user`, so it lives for the duration of a request.
+
+    Use Account.get_billing_state() rather than instantiating this directly;
+    the account throws the snapshot away whenever its subscriptions change.
+    """
+    def __init__(self, account):
+        self.account = account
+        self._values = {}
+    def _get(self, key, compute):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = compute()
+            return value
+    @property
+    def current_subscription(self):
+        return self._get('current_subscription',
+            self.account.get_current_subscription)
+    @property
+    def current_product_class(self):
+        def compute():
+            sub = self.current_subscription
+            if sub:
+                return sub.get_product_class()
+            return billing.loading.get_default_product()
+        return self._get('current_product_class', compute)
+    @property
+    def visible_products(self):
+        return self._get('visible_products',
+            self.account.get_visible_products)
+    @property
+    def has_valid_billing_details(self):
+        return self._get('has_valid_billing_details',
+            self.account.has_valid_billing_details)
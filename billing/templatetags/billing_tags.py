@@ -7,18 +7,18 @@ register = template.Library()
 
 @register.filter
 def product_change_type(product, user):
-    upc = user.billing_account.get_current_product_class()
+    upc = user.billing_account.get_billing_state().current_product_class
     if isinstance(product, Product):
         product = type(product)
-    if upc:
-        products = billing.loading.get_products(hidden=True)
-        upc_index = products.index(upc)
-        p_index = products.index(product)
-        if upc_index < p_index:
-            return 'upgrade'
-        elif upc_index == p_index:
-            return None
-        else:
-            return 'downgrade'
-    else:
-        return 'upgrade'
+    return billing.loading.get_product_change_type(upc, product)
+
+@register.filter
+def product_change_types(products, user):
+    """
+    pairs each product with its change type for the given user, e.g.:
+
+    {% for product, change_type in products|product_change_types:user %}
+    """
+    upc = user.billing_account.get_billing_state().current_product_class
+    products = [type(p) if isinstance(p, Product) else p for p in products]
+    return billing.loading.get_product_change_types(upc, products)
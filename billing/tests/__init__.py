@@ -1,27 +1,54 @@
 #!/usr/bin/env python
 
+import datetime
+import json
+from decimal import Decimal
+from StringIO import StringIO
+
 from django.utils import unittest
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.management import call_command
 from django.core import serializers
+from django.core.cache import cache
+from django.db import connection
 
 JSONSerializer = serializers.get_serializer("json")
 
 from ordereddict import OrderedDict
 
 from billing import loading
+import billing.adjustments
+import billing.approval
+import billing.archiving
+import billing.benchmark
+import billing.importing
+import billing.instrumentation
+import billing.invoicing
+import billing.quotas
+import billing.replicas
+import billing.usage
+import billing.vectorized_pricing
+import billing.views
 from billing.models import *
+from billing.processor.utils import MasterProcessorRouter, router as processor_router
 from billing.processor.simple_account.processor import SimpleAccountBillingProcessor
 from billing.processor.simple_account.models import IOUAccount, AccountIOU
 from billing.templatetags import billing_tags
+from billing.signals import ready_for_approval, operation_timed
+from billing.tests import stub_gateway
 
 from example_saas_project.core import billing as billing_defs
 from example_saas_project.core import products as product_defs
+from example_saas_project.core.models import Project
 
 
 class UserTestCase(TestCase):
     fixtures = ['test_users.json']
     def setUp(self):
+        # cached billing data is keyed by pk, which the test database reuses
+        cache.clear()
+        processor_router.clear()
         from django.contrib.auth.models import User
         self.u = User.objects.create_user(
             username='testuser',
@@ -96,10 +123,331 @@ class AccountTests(UserTestCase):
         self.assertListEqual(self.a.get_visible_products(), all_products)
         self.a.subscribe_to_product(billing_defs.SecretPlan)
         self.assertListEqual(self.a.get_visible_products(), all_products)
+    def test_subscribed_product_types(self):
+        self.assertEqual(self.a.subscribed_product_types, '')
+        self.a.subscribe_to_product(billing_defs.SecretPlan)
+        pt = ProductType.objects.get_for_product(billing_defs.SecretPlan)
+        self.assertEqual(
+            Account.objects.get(pk=self.a.pk).subscribed_product_types,
+            '%x' % (1 << pt.pk))
+    def test_get_visible_products_queries(self):
+        self.a.subscribe_to_product(billing_defs.SecretPlan)
+        self.a.get_visible_products()
+        with self.assertNumQueries(0):
+            self.assertIn(billing_defs.SecretPlan, self.a.get_visible_products())
+
+class AccountQuerySetTests(UserTestCase):
+    def setUp(self):
+        super(AccountQuerySetTests, self).setUp()
+        from django.contrib.auth.models import User
+        self.u2 = User.objects.create_user(username='u2', email='u2@x.com')
+        self.u3 = User.objects.create_user(username='u3', email='u3@x.com')
+        self.u.billing_account.subscribe_to_product('FreePlan')
+        self.u.billing_account.subscribe_to_product('SecretFreePlan')
+        self.u2.billing_account.subscribe_to_product('GoldPlan')  # declined
+        self.u3.billing_account.subscribe_to_product('FreePlan')
+    def test_with_current_product(self):
+        expected = {
+            self.u.pk: billing_defs.SecretFreePlan,
+            self.u2.pk: None,
+            self.u3.pk: billing_defs.FreePlan,
+        }
+        # one query for the accounts, two for their current subscriptions
+        with self.assertNumQueries(3):
+            accounts = list(Account.objects.with_current_product())
+            actual = dict(
+                (a.owner.pk, a.get_current_product_class()) for a in accounts)
+        self.assertEqual(actual, expected)
+    def test_with_current_product_filtered(self):
+        qs = Account.objects.with_current_product().filter(owner=self.u3)
+        self.assertEqual(
+            [a.get_current_product_class() for a in qs],
+            [billing_defs.FreePlan])
+    def test_get_current_for_many_accounts(self):
+        # more accounts than SQLite will bind parameters for in one query
+        accounts = [Account(pk=pk) for pk in range(10000, 11000)]
+        accounts.append(self.u3.billing_account)
+        current = Subscription.objects.get_current_for_accounts(accounts)
+        self.assertEqual(current.keys(), [self.u3.billing_account.pk])
+    def test_subscribe_clears_resolved_subscription(self):
+        a = Account.objects.with_current_product().get(owner=self.u3)
+        a.subscribe_to_product('SecretFreePlan')
+        self.assertEqual(
+            a.get_current_product_class(), billing_defs.SecretFreePlan)
+
+class BillingStateTests(UserTestCase):
+    def setUp(self):
+        super(BillingStateTests, self).setUp()
+        self.a = self.u.billing_account
+    def test_memoized(self):
+        state = self.a.get_billing_state()
+        self.assertIs(state, self.a.get_billing_state())
+        self.assertIsNone(state.current_product_class)
+        with self.assertNumQueries(0):
+            self.assertIsNone(state.current_subscription)
+            self.assertIsNone(state.current_product_class)
+    def test_invalidated_by_subscribe(self):
+        state = self.a.get_billing_state()
+        self.assertIsNone(state.current_product_class)
+        self.a.subscribe_to_product('FreePlan')
+        state = self.a.get_billing_state()
+        self.assertEqual(state.current_product_class, billing_defs.FreePlan)
+    def test_invalidated_by_status_change(self):
+        sub = self.a.subscribe_to_product('FreePlan')
+        state = self.a.get_billing_state()
+        self.assertEqual(state.current_product_class, billing_defs.FreePlan)
+        sub.set_current_approval_status('declined')
+        state = self.a.get_billing_state()
+        self.assertIsNone(state.current_product_class)
+
+class UsageCounterTests(UserTestCase):
+    def setUp(self):
+        super(UsageCounterTests, self).setUp()
+        self.a = self.u.billing_account
+        self.p1 = Project.objects.create(account=self.a, name='one')
+        self.p2 = Project.objects.create(account=self.a, name='two')
+    def test_counts_saves_and_deletes(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 2)
+        self.p1.name = 'renamed'
+        self.p1.save()
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 2)
+        self.p2.delete()
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 1)
+    def test_delete_account_owner(self):
+        self.u.delete()
+        self.assertFalse(UsageCounter.objects.exists())
+    def test_unused_feature(self):
+        self.assertEqual(billing.usage.get_usage(self.a, 'StorageSpace'), 0)
+    def test_reconcile(self):
+        self.p1.delete()
+        UsageCounter.objects.all().delete()
+        self.assertEqual(billing.usage.reconcile(['Projects'], batch_size=1), 1)
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 1)
+        self.assertEqual(billing.usage.reconcile(), 0)
+    def test_reconcile_resets_cached_usage(self):
+        self.assertEqual(billing.quotas.get_usage(self.a, 'Projects'), 2)
+        UsageCounter.objects.update(count=10)
+        billing.usage.reconcile(['Projects'])
+        self.assertEqual(billing.quotas.get_usage(self.a, 'Projects'), 2)
+    def test_increment_within(self):
+        self.assertTrue(billing.usage.increment_within(self.a, 'Projects', 3))
+        self.assertFalse(billing.usage.increment_within(self.a, 'Projects', 3))
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 3)
+        # creates the counter if there isn't one yet
+        self.assertFalse(
+            billing.usage.increment_within(self.a, 'ApiCalls', 1, 2))
+        self.assertTrue(billing.usage.increment_within(self.a, 'ApiCalls', 1))
+        self.assertEqual(billing.usage.get_usage(self.a, 'ApiCalls'), 1)
+    def test_reconcile_command(self):
+        UsageCounter.objects.update(count=10)
+        call_command('reconcile_usage_counters', 'Projects')
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 2)
+
+class QuotaTests(UserTestCase):
+    def setUp(self):
+        super(QuotaTests, self).setUp()
+        self.a = self.u.billing_account
+        self.a.subscribe_to_product('FreePlan')  # includes one project
+    def test_limits(self):
+        self.assertEqual(billing.quotas.get_limit(self.a, 'Projects'), 1)
+        # FreePlan includes no storage space
+        self.assertEqual(billing.quotas.get_limit(self.a, 'StorageSpace'), 0)
+    def test_can_use(self):
+        self.assertTrue(self.a.can_use('Projects'))
+        self.assertFalse(self.a.can_use('Projects', 2))
+        Project.objects.create(account=self.a, name='one')
+        with self.assertNumQueries(0):
+            self.assertFalse(self.a.can_use('Projects'))
+    def test_reserve(self):
+        self.assertTrue(billing.quotas.reserve(self.a, 'Projects'))
+        self.assertFalse(billing.quotas.reserve(self.a, 'Projects'))
+        # the reservation is written back to the database
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 1)
+        cache.clear()
+        self.assertFalse(self.a.can_use('Projects'))
+        billing.quotas.release(self.a, 'Projects')
+        self.assertTrue(self.a.can_use('Projects'))
+    def test_reserve_after_eviction(self):
+        self.a.can_use('Projects')  # caches the usage
+        incr = cache.incr
+        evicted = []
+        def evicting_incr(key, delta=1, version=None):
+            # the usage is evicted just before reserve() increments it
+            if not evicted:
+                evicted.append(key)
+                cache.delete(key)
+            return incr(key, delta, version)
+        cache.incr = evicting_incr
+        try:
+            self.assertTrue(billing.quotas.reserve(self.a, 'Projects'))
+        finally:
+            del cache.incr
+        self.assertTrue(evicted)
+        self.assertEqual(billing.quotas.get_usage(self.a, 'Projects'), 1)
+        self.assertFalse(self.a.can_use('Projects'))
+    def test_reserve_after_eviction_at_limit(self):
+        self.a.can_use('Projects')  # caches the usage
+        incr = cache.incr
+        def evicting_incr(key, delta=1, version=None):
+            # another process takes the last unit once the usage is evicted
+            cache.delete(key)
+            billing.usage.increment(self.a, 'Projects', update_cache=False)
+            return incr(key, delta, version)
+        cache.incr = evicting_incr
+        try:
+            self.assertFalse(billing.quotas.reserve(self.a, 'Projects'))
+        finally:
+            del cache.incr
+        self.assertEqual(billing.usage.get_usage(self.a, 'Projects'), 1)
+    def test_limits_follow_subscription(self):
+        self.assertEqual(billing.quotas.get_limit(self.a, 'Projects'), 1)
+        self.a.subscribe_to_product('SecretFreePlan')
+        self.assertEqual(billing.quotas.get_limit(self.a, 'Projects'), 2)
+    def test_quota_required(self):
+        from django.core.exceptions import PermissionDenied
+        from django.test.client import RequestFactory
+        @billing.quotas.quota_required('Projects', consume=True)
+        def view(request):
+            return 'ok'
+        request = RequestFactory().get('/')
+        request.user = self.u
+        self.assertEqual(view(request), 'ok')
+        self.assertRaises(PermissionDenied, view, request)
+
+class InvoicingTests(UserTestCase):
+    def setUp(self):
+        super(InvoicingTests, self).setUp()
+        from django.contrib.auth.models import User
+        self.a = self.u.billing_account
+        iou_account = IOUAccount.objects.create(billing_account=self.a)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
+        self.a.subscribe_to_product('SilverPlan')
+        Project.objects.create(account=self.a, name='one')
+        Project.objects.create(account=self.a, name='two')
+        billing.usage.increment(self.a, 'StorageSpace', 100)
+        self.a2 = User.objects.create_user('u2', 'u2@x.com').billing_account
+        self.a3 = User.objects.create_user('u3', 'u3@x.com').billing_account
+        self.a3.subscribe_to_product('FreePlan')
+        Subscription.objects.update(date_created=datetime.datetime(2011, 12, 1))
+        self.start = datetime.date(2012, 1, 1)
+        self.end = datetime.date(2012, 1, 31)
+    def test_line_items(self):
+        pricing = billing.invoicing.ProductPricing(billing_defs.SilverPlan)
+        items = pricing.get_line_items({'Projects': 2, 'StorageSpace': 100})
+        self.assertEqual(items, [
+            ('SilverPlan', '', 1, Decimal(75), Decimal(75)),
+            ('Projects (5 included)', 'Projects', 2, Decimal(0), Decimal(0)),
+            ('StorageSpace', 'StorageSpace', 100,
+                Decimal('0.15'), Decimal('15.00')),
+        ])
+    def test_run_billing(self):
+        run = billing.invoicing.run_billing(self.start, self.end, chunk_size=1)
+        self.assertIsNotNone(run.date_completed)
+        invoices = dict((i.billing_account_id, i) for i in run.invoices.all())
+        self.assertEqual(set(invoices), set([self.a.pk, self.a3.pk]))
+        self.assertEqual(invoices[self.a.pk].total, Decimal('90.00'))
+        self.assertEqual(invoices[self.a.pk].line_items.count(), 3)
+        self.assertEqual(invoices[self.a3.pk].total, Decimal('0.00'))
+        # re-running a completed period does nothing
+        billing.invoicing.run_billing(self.start, self.end)
+        self.assertEqual(Invoice.objects.count(), 2)
+    def test_bills_subscription_in_effect(self):
+        self.a.subscribe_to_product('GoldPlan')  # after the period
+        run = billing.invoicing.run_billing(self.start, self.end)
+        invoice = run.invoices.get(billing_account=self.a)
+        self.assertEqual(invoice.product_type.name, 'SilverPlan')
+        Subscription.objects.filter(billing_account=self.a,
+            product_type__name='GoldPlan',
+        ).update(date_created=datetime.datetime(2012, 1, 15))
+        run = billing.invoicing.run_billing(self.start, datetime.date(2012, 2, 29))
+        invoice = run.invoices.get(billing_account=self.a)
+        self.assertEqual(invoice.product_type.name, 'GoldPlan')
+    @override_settings(BILLING_DEFAULT_PRODUCT='FreePlan')
+    def test_default_product(self):
+        run = billing.invoicing.run_billing(self.start, self.end)
+        invoice = run.invoices.get(billing_account=self.a2)
+        self.assertEqual(invoice.product_type.name, 'FreePlan')
+        self.assertEqual(invoice.total, Decimal('0.00'))
+    def test_resume(self):
+        BillingRun.objects.create(period_start=self.start,
+            period_end=self.end, last_account_id=self.a.pk)
+        run = billing.invoicing.run_billing(self.start, self.end)
+        self.assertEqual(
+            [i.billing_account_id for i in run.invoices.all()], [self.a3.pk])
+    def test_command(self):
+        call_command('run_billing', '2012-01')
+        run = BillingRun.objects.get()
+        self.assertEqual(run.period_end, self.end)
+        self.assertEqual(run.invoices.count(), 2)
+
+class VectorizedPricingTests(UserTestCase):
+    def setUp(self):
+        super(VectorizedPricingTests, self).setUp()
+        if billing.vectorized_pricing.numpy is None:
+            self.skipTest('numpy is not installed')
+        self.catalog = billing.vectorized_pricing.CompiledCatalog([
+            billing_defs.FreePlan, billing_defs.SilverPlan])
+    def test_compile(self):
+        self.assertEqual(self.catalog.features, ['Projects', 'StorageSpace'])
+        self.assertEqual(list(self.catalog.base_prices), [0, 750000])
+        self.assertEqual(self.catalog.unit_prices.tolist(), [[0, 0], [0, 1500]])
+    def test_price_matches_line_items(self):
+        usage = [[3, 7], [2, 7], [9, 333]]
+        products = [0, 1, 1]
+        prices = self.catalog.price(products, usage)
+        for i, product_index in enumerate(products):
+            pricing = billing.invoicing.ProductPricing(
+                self.catalog.products[product_index])
+            items = pricing.get_line_items(
+                dict(zip(self.catalog.features, usage[i])))
+            self.assertEqual(prices[i], sum(item[4] for item in items))
+        self.assertEqual(prices[2], Decimal('124.95'))
+    def test_overages(self):
+        overages = self.catalog.get_overages([0, 1], [[3, 7], [2, 7]])
+        self.assertEqual(overages.tolist(), [[2, 7], [0, 0]])
+    def test_price_accounts(self):
+        a = self.u.billing_account
+        a.subscribe_to_product('FreePlan')
+        billing.usage.increment(a, 'StorageSpace', 10)
+        accounts = Account.objects.with_current_product()
+        self.assertEqual(
+            billing.vectorized_pricing.price_accounts(accounts),
+            {a.pk: Decimal('0.00')})
+        self.assertEqual(
+            billing.vectorized_pricing.price_accounts(
+                accounts, product_class=billing_defs.SilverPlan),
+            {a.pk: Decimal('76.50')})
+    def test_price_accounts_adjusted(self):
+        a = self.u.billing_account
+        iou_account = IOUAccount.objects.create(billing_account=a)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
+        sub = a.subscribe_to_product('SilverPlan')
+        Adjustment.objects.create(subscription=sub,
+            adjustment_type=AdjustmentType.objects.create(name='Discount'),
+            adjustment_value={'percent': '33.333'})
+        billing.usage.increment(a, 'StorageSpace', 7)
+        Subscription.objects.filter(pk=sub.pk).update(
+            date_created=datetime.datetime(2011, 12, 1))
+        prices = billing.vectorized_pricing.price_accounts(
+            Account.objects.with_current_product())
+        self.assertEqual(prices, {a.pk: Decimal('51.05')})
+        run = billing.invoicing.run_billing(
+            datetime.date(2012, 1, 1), datetime.date(2012, 1, 31))
+        self.assertEqual(run.invoices.get(billing_account=a).total, prices[a.pk])
 
 class ProductTypeTests(UserTestCase):
     def test_autodiscover(self):
         self.assertEqual(ProductType.objects.count(), 6)
+    def test_update_all_producttypes(self):
+        ProductType.objects.filter(name='GoldPlan').delete()
+        ProductType.objects.create(name='StalePlan')
+        with self.assertNumQueries(2):
+            billing.management.update_all_producttypes(verbosity=0)
+        names = set(ProductType.objects.values_list('name', flat=True))
+        self.assertIn('GoldPlan', names)
+        # stale types are only deleted after interactive confirmation
+        self.assertIn('StalePlan', names)
     def test_get_product_class(self):
         cls = ProductType.objects.get(name='GoldPlan').get_product_class()
         self.assertEqual(cls, billing_defs.GoldPlan)
@@ -146,6 +494,11 @@ class SubscriptionManagerTests(UserTestCase):
         self.assertIn(self.sub2, Subscription.objects.approved())
         self.assertNotIn(self.sub2, Subscription.objects.pending())
         self.assertNotIn(self.sub2, Subscription.objects.declined())
+    def test_current_status_denormalized(self):
+        sub1 = Subscription.objects.get(pk=self.sub1.pk)
+        self.assertEqual(sub1.current_status, 'pending')
+        self.assertEqual(sub1.current_status_date, self.stat1_2.created)
+        self.assertEqual(self.sub2.current_status, 'approved')
     def test_create_from_product_class(self):
         iou_account = IOUAccount.objects.create(
             billing_account=self.u.billing_account)
@@ -170,6 +523,45 @@ class SubscriptionManagerTests(UserTestCase):
         self.assertEqual(
             self.u.billing_account.get_current_product_class(),
             billing_defs.GoldPlan)
+    def test_bulk_create_from_product(self):
+        from django.contrib.auth.models import User
+        u2 = User.objects.create_user(username='u2', email='u2@x.com')
+        iou_account = IOUAccount.objects.create(billing_account=u2.billing_account)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
+        accounts = [self.u.billing_account, u2.billing_account]
+        subs = Subscription.objects.bulk_create_from_product('GoldPlan', accounts)
+        self.assertEqual(len(subs), 2)
+        statuses = dict((s.billing_account_id, s.current_status) for s in subs)
+        self.assertEqual(statuses, {
+            self.u.billing_account.pk: 'declined',
+            u2.billing_account.pk: 'approved',
+        })
+        self.assertEqual(
+            u2.billing_account.get_current_product_class(),
+            billing_defs.GoldPlan)
+        self.assertEqual(
+            self.u.billing_account.get_current_product_class(),
+            billing_defs.SilverPlan)
+        approved_sub = Subscription.objects.get(
+            billing_account=u2.billing_account)
+        self.assertEqual(
+            [s.status for s in approved_sub.approval_statuses.order_by('pk')],
+            ['pending', 'approved'])
+    def test_bulk_create_from_product_subscribed_product_types(self):
+        from django.contrib.auth.models import User
+        u2 = User.objects.create_user(username='u2', email='u2@x.com')
+        accounts = [self.u.billing_account, u2.billing_account]
+        Subscription.objects.bulk_create_from_product('SecretPlan', accounts)
+        for account in accounts:
+            self.assertIn(billing_defs.SecretPlan, account.get_visible_products())
+            self.assertIn(billing_defs.SecretPlan,
+                Account.objects.get(pk=account.pk).get_visible_products())
+        u3 = User.objects.create_user(username='u3', email='u3@x.com')
+        self.assertNotIn(billing_defs.SecretPlan,
+            u3.billing_account.get_visible_products())
+    def test_bulk_create_from_product_empty(self):
+        self.assertEqual(
+            Subscription.objects.bulk_create_from_product('GoldPlan', []), [])
     def test_create_from_product_declined(self):
         self.assertEqual(
             self.u.billing_account.get_current_product_class(),
@@ -180,15 +572,304 @@ class SubscriptionManagerTests(UserTestCase):
             self.u.billing_account.get_current_product_class(),
             billing_defs.SilverPlan)
 
-class SubscriptionTests(TestCase):
+class SubscriptionTests(UserTestCase):
     def setUp(self):
-        pass
+        super(SubscriptionTests, self).setUp()
+        pt = ProductType.objects.get(name='GoldPlan')
+        self.sub = Subscription.objects.create(
+            product_type=pt, billing_account=self.u.billing_account)
         
     def tearDown(self):
         pass
         
     def test_init(self):
-        pass
+        self.assertEqual(self.sub.get_current_approval_status(), 'pending')
+    def test_set_current_approval_status(self):
+        self.sub.set_current_approval_status('approved')
+        self.assertEqual(self.sub.get_current_approval_status(), 'approved')
+        sub = Subscription.objects.get(pk=self.sub.pk)
+        self.assertEqual(sub.current_status, 'approved')
+        self.assertEqual(
+            sub.current_status_date,
+            sub.approval_statuses.latest('created').created)
+    def test_set_invalid_approval_status(self):
+        self.assertRaises(
+            ValueError, self.sub.set_current_approval_status, 'bogus')
+        self.assertEqual(self.sub.get_current_approval_status(), 'pending')
+
+@override_settings(
+    BILLING_APPROVAL_BACKEND='billing.approval.DatabaseApprovalBackend')
+class ApprovalQueueTests(UserTestCase):
+    def setUp(self):
+        super(ApprovalQueueTests, self).setUp()
+        from django.contrib.auth.models import User
+        self.a = self.u.billing_account
+        self.a2 = User.objects.create_user('u2', 'u2@x.com').billing_account
+        iou_account = IOUAccount.objects.create(billing_account=self.a)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
+    def test_subscribe_queues_job(self):
+        sub = self.a.subscribe_to_product('GoldPlan')
+        self.assertEqual(sub.get_current_approval_status(), 'pending')
+        self.assertEqual(ApprovalJob.objects.filter(subscription=sub).count(), 1)
+    def test_process_jobs(self):
+        sub = self.a.subscribe_to_product('GoldPlan')
+        sub2 = self.a2.subscribe_to_product('GoldPlan')
+        self.assertEqual(billing.approval.process_approval_jobs(), (2, 0))
+        self.assertFalse(ApprovalJob.objects.exists())
+        self.assertEqual(
+            Subscription.objects.get(pk=sub.pk).current_status, 'approved')
+        self.assertEqual(
+            Subscription.objects.get(pk=sub2.pk).current_status, 'declined')
+    def test_bulk_subscribe_queues_jobs(self):
+        Subscription.objects.bulk_create_from_product(
+            'GoldPlan', [self.a, self.a2])
+        self.assertEqual(ApprovalJob.objects.count(), 2)
+        self.assertEqual(billing.approval.process_approval_jobs(), (2, 0))
+    def test_claims_do_not_overlap(self):
+        Subscription.objects.bulk_create_from_product(
+            'GoldPlan', [self.a, self.a2])
+        first = billing.approval.claim_jobs(batch_size=1)
+        second = billing.approval.claim_jobs(batch_size=5)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first[0].pk, second[0].pk)
+        self.assertEqual(billing.approval.claim_jobs(), [])
+    def test_abandoned_claims_reclaimed(self):
+        self.a.subscribe_to_product('GoldPlan')
+        self.assertEqual(len(billing.approval.claim_jobs()), 1)
+        self.assertEqual(billing.approval.claim_jobs(), [])
+        self.assertEqual(len(billing.approval.claim_jobs(claim_timeout=-1)), 1)
+    def test_failed_job_requeued(self):
+        def fail(sender, **kwargs):
+            raise RuntimeError('gateway down')
+        ready_for_approval.connect(fail)
+        try:
+            self.a.subscribe_to_product('GoldPlan')
+            self.assertEqual(
+                billing.approval.process_approval_jobs(max_batches=1), (1, 1))
+        finally:
+            ready_for_approval.disconnect(fail)
+        job = ApprovalJob.objects.get()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue('gateway down' in job.last_error)
+        self.assertTrue(job.not_before > datetime.datetime.now())
+        # not retried until its backoff has passed
+        self.assertEqual(billing.approval.process_approval_jobs(), (0, 0))
+        ApprovalJob.objects.update(not_before=datetime.datetime.now())
+        self.assertEqual(billing.approval.process_approval_jobs(), (1, 0))
+    def test_failed_job_backoff(self):
+        def fail(sender, **kwargs):
+            raise RuntimeError('gateway down')
+        ready_for_approval.connect(fail)
+        try:
+            self.a.subscribe_to_product('GoldPlan')
+            # the failed job isn't claimed again by the same loop
+            self.assertEqual(billing.approval.process_approval_jobs(), (1, 1))
+            ApprovalJob.objects.update(not_before=None)
+            start = datetime.datetime.now()
+            billing.approval.run_jobs(billing.approval.claim_jobs(),
+                max_attempts=3, retry_delay=10)
+            job = ApprovalJob.objects.get()
+            self.assertEqual(job.attempts, 2)
+            # the delay doubles with each attempt
+            self.assertTrue(
+                job.not_before >= start + datetime.timedelta(seconds=20))
+            ApprovalJob.objects.update(not_before=None)
+            billing.approval.run_jobs(
+                billing.approval.claim_jobs(), max_attempts=3)
+        finally:
+            ready_for_approval.disconnect(fail)
+        job = ApprovalJob.objects.get()
+        self.assertEqual(job.attempts, 3)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(billing.approval.claim_jobs(), [])
+    def test_failed_batch_not_decided_twice(self):
+        from billing.signals import batch_ready_for_approval
+        def fail(sender, **kwargs):
+            raise RuntimeError('batch failed')
+        self.a.subscribe_to_product('GoldPlan')
+        self.a2.subscribe_to_product('GoldPlan')
+        # connected after the processor's receiver, which has already
+        # decided the batch by the time this fails
+        batch_ready_for_approval.connect(fail)
+        try:
+            self.assertEqual(billing.approval.process_approval_jobs(), (2, 0))
+        finally:
+            batch_ready_for_approval.disconnect(fail)
+        self.assertFalse(ApprovalJob.objects.exists())
+        for sub in Subscription.objects.all():
+            self.assertEqual(
+                [s.status for s in sub.approval_statuses.order_by('pk')],
+                ['pending', sub.current_status])
+            self.assertNotEqual(sub.current_status, 'pending')
+
+class BenchmarkTests(UserTestCase):
+    def test_run_benchmarks(self):
+        results = billing.benchmark.run_benchmarks(scales=[20], sample_size=5)
+        self.assertEqual(
+            [r['benchmark'] for r in results],
+            ['get_current_subscription', 'filter_by_current_statuses',
+             'get_visible_products', 'admin_changelist',
+             'subscription_view_dispatch'])
+        for r in results:
+            self.assertFalse('error' in r, r.get('error'))
+            self.assertEqual(r['scale'], 20)
+            self.assertTrue(r['queries'] > 0)
+    def test_generate(self):
+        account_ids = billing.benchmark.generate(10, 2, 3)
+        self.assertEqual(len(account_ids), 10)
+        subs = Subscription.objects.filter(billing_account__in=account_ids)
+        self.assertEqual(subs.count(), 20)
+        self.assertEqual(SubscriptionApprovalStatus.objects
+            .filter(subscription__in=subs).count(), 60)
+
+class InstrumentationTests(UserTestCase):
+    def setUp(self):
+        super(InstrumentationTests, self).setUp()
+        self.a = self.u.billing_account
+        self.sink = billing.instrumentation.connect_sink(
+            billing.instrumentation.HistogramSink())
+    def tearDown(self):
+        billing.instrumentation.disable()
+        operation_timed.disconnect(dispatch_uid=id(self.sink))
+    def test_disabled(self):
+        self.a.get_current_subscription()
+        self.assertEqual(self.sink.snapshot(), {})
+    def test_timings_recorded(self):
+        billing.instrumentation.enable()
+        self.a.get_current_subscription()
+        self.a.get_current_subscription()
+        stats = self.sink.snapshot()['account.get_current_subscription']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['queries'], 2)
+        self.assertEqual(sum(stats['histogram']), 2)
+    def test_nested_operations(self):
+        logged = len(connection.queries)
+        billing.instrumentation.enable()
+        self.a.has_valid_billing_details()
+        stats = self.sink.snapshot()
+        self.assertEqual(stats['processor.has_valid_billing_details']['count'], 1)
+        self.assertEqual(
+            stats['router.get_processor_name_for_account']['count'], 1)
+        # the queries are left in the log, and counted by the outermost
+        # operation
+        self.assertEqual(len(connection.queries) - logged,
+            max(s['queries'] for s in stats.values()))
+    def test_outer_query_count(self):
+        billing.instrumentation.enable()
+        with self.assertNumQueries(1):
+            self.a.get_current_subscription()
+        stats = self.sink.snapshot()['account.get_current_subscription']
+        self.assertEqual(stats['queries'], 1)
+
+class ImportTests(UserTestCase):
+    def setUp(self):
+        super(ImportTests, self).setUp()
+        from django.contrib.auth.models import User
+        self.u2 = User.objects.create_user('u2', 'u2@x.com')
+        self.failures = []
+    def import_rows(self, rows, **kwargs):
+        return billing.importing.import_subscriptions(rows,
+            on_failure=lambda *failure: self.failures.append(failure), **kwargs)
+    def test_read_csv(self):
+        f = StringIO('user,product\ntestuser,FreePlan\n\n2, GoldPlan\nbad\n')
+        self.assertEqual(list(billing.importing.read_csv(f)), [
+            (2, 'testuser', 'FreePlan'),
+            (4, '2', 'GoldPlan'),
+            (5, None, None),
+        ])
+    def test_read_csv_non_ascii(self):
+        from django.contrib.auth.models import User
+        User.objects.create_user(u'jos\xe9', 'jose@x.com')
+        f = StringIO(u'jos\xe9,FreePlan\n'.encode('latin-1'))
+        rows = list(billing.importing.read_csv(f, encoding='latin-1'))
+        self.assertEqual(rows, [(1, u'jos\xe9', u'FreePlan')])
+        self.assertEqual(self.import_rows(rows), (1, 0))
+        f = StringIO(u'jos\xe9,FreePlan\n'.encode('latin-1'))
+        self.assertEqual(list(billing.importing.read_csv(f)), [(1, None, None)])
+    def test_read_jsonl(self):
+        f = StringIO('{"user": 2, "product": "GoldPlan"}\n{"user": 3}\n'
+            '{"user": 3, "product": ["GoldPlan"]}\n{"user": {}, "product": "x"}\n')
+        self.assertEqual(list(billing.importing.read_jsonl(f)), [
+            (1, u'2', 'GoldPlan'),
+            (2, None, None),
+            (3, None, None),
+            (4, None, None),
+        ])
+    def test_import(self):
+        rows = [
+            (1, 'testuser', 'FreePlan'),
+            (2, str(self.u2.pk), 'FreePlan'),
+            (3, 'nobody', 'FreePlan'),
+            (4, 'testuser', 'NoSuchPlan'),
+        ]
+        self.assertEqual(self.import_rows(rows, chunk_size=3), (2, 2))
+        self.assertEqual([f[0] for f in self.failures], [3, 4])
+        for user in (self.u, self.u2):
+            self.assertEqual(
+                Account.objects.get(owner=user).get_current_product_class(),
+                billing_defs.FreePlan)
+    def test_import_applies_duplicate_rows_in_order(self):
+        rows = [
+            (1, 'testuser', 'SecretFreePlan'),
+            (2, 'u2', 'FreePlan'),
+            (3, 'testuser', 'FreePlan'),
+        ]
+        self.assertEqual(self.import_rows(rows), (3, 0))
+        self.assertEqual(Subscription.objects.filter(
+            billing_account__owner=self.u).count(), 2)
+        self.assertEqual(
+            Account.objects.get(owner=self.u).get_current_product_class(),
+            billing_defs.FreePlan)
+    def test_import_creates_missing_accounts(self):
+        self.assertFalse(Account.objects.filter(owner=self.u2).exists())
+        self.assertEqual(self.import_rows([(1, 'u2', 'FreePlan')]), (1, 0))
+        self.assertTrue(Account.objects.filter(owner=self.u2).exists())
+
+class ArchivingTests(UserTestCase):
+    def setUp(self):
+        super(ArchivingTests, self).setUp()
+        pt = ProductType.objects.get(name='GoldPlan')
+        self.sub = Subscription.objects.create(
+            product_type=pt, billing_account=self.u.billing_account)
+        self.sub.approval_statuses.all().delete()
+        start = datetime.datetime(2012, 1, 1)
+        for i, status in enumerate(['pending', 'approved', 'declined']):
+            SubscriptionApprovalStatus.objects.create(subscription=self.sub,
+                status=status, created=start + datetime.timedelta(days=i))
+        self.before = datetime.datetime(2013, 1, 1)
+    def test_compact_keeps_newest_status(self):
+        moved = billing.archiving.compact_approval_statuses(
+            self.before, batch_size=1)
+        self.assertEqual(moved, 2)
+        self.assertEqual(
+            list(self.sub.approval_statuses.values_list('status', flat=True)),
+            ['declined'])
+        self.assertEqual(
+            Subscription.objects.get(pk=self.sub.pk).get_current_approval_status(),
+            'declined')
+        self.assertEqual(sorted(self.sub.archived_approval_statuses
+            .values_list('status', flat=True)), ['approved', 'pending'])
+        self.assertEqual(
+            billing.archiving.compact_approval_statuses(self.before), 0)
+    def test_compact_resumable(self):
+        billing.archiving.compact_approval_statuses(
+            self.before, batch_size=1, max_batches=1)
+        self.assertEqual(self.sub.approval_statuses.count(), 2)
+        billing.archiving.compact_approval_statuses(self.before)
+        self.assertEqual(self.sub.approval_statuses.count(), 1)
+    def test_retention_window(self):
+        moved = billing.archiving.compact_approval_statuses(
+            datetime.datetime(2012, 1, 2))
+        self.assertEqual(moved, 1)
+    def test_compact_to_file(self):
+        f = StringIO()
+        billing.archiving.compact_approval_statuses(
+            self.before, billing.archiving.JSONLinesArchive(f))
+        rows = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual([r['status'] for r in rows], ['pending', 'approved'])
+        self.assertFalse(ArchivedApprovalStatus.objects.exists())
 
 class DefaultProductTests(UserTestCase):
     def setUp(self):
@@ -214,15 +895,73 @@ class DefaultProductTests(UserTestCase):
         self.assertIsInstance(p, billing_defs.GoldPlan)
 
 
-class AdjustmentTests(TestCase):
+class AdjustmentTests(UserTestCase):
     def setUp(self):
-        pass
-        
-    def tearDown(self):
-        pass
-        
-    def test_init(self):
-        pass
+        super(AdjustmentTests, self).setUp()
+        self.a = self.u.billing_account
+        self.sub = self.a.subscribe_to_product('FreePlan')
+        self.discount = AdjustmentType.objects.create(name='Discount')
+        self.inclusion = AdjustmentType.objects.create(name='InclusionOverride')
+    def adjust(self, adjustment_type, value, sub=None):
+        return Adjustment.objects.create(subscription=sub or self.sub,
+            adjustment_type=adjustment_type, adjustment_value=value)
+    def test_unadjusted(self):
+        self.assertIs(self.sub.get_adjusted_product_class(), billing_defs.FreePlan)
+        with self.assertNumQueries(0):
+            self.sub.get_adjusted_product_class()
+    def test_discount(self):
+        pc = billing.adjustments.get_adjusted_product_class(
+            billing_defs.SilverPlan, [('Discount', {'percent': 20})])
+        self.assertTrue(issubclass(pc, billing_defs.SilverPlan))
+        self.assertEqual(pc.name, 'SilverPlan')
+        self.assertEqual(pc.base_price, Decimal(60))
+        pc = billing.adjustments.get_adjusted_product_class(
+            billing_defs.SilverPlan, [('Discount', {'amount': '100'})])
+        self.assertEqual(pc.base_price, Decimal(0))
+    def test_inclusion_override(self):
+        self.adjust(self.inclusion, {'Projects': 3})
+        self.assertEqual(billing.quotas.get_limit(self.a, 'Projects'), 3)
+        self.assertTrue(self.a.can_use('Projects', 3))
+    def test_invalid_inclusion_override(self):
+        self.assertRaises(ValueError,
+            billing.adjustments.get_adjusted_product_class,
+            billing_defs.GoldPlan, [('InclusionOverride', {'StorageSpace': 5})])
+    def test_unknown_adjustment_ignored(self):
+        placeholder = AdjustmentType.objects.create(name='AdjustmentType99')
+        self.adjust(placeholder, {})
+        self.adjust(self.inclusion, {'Projects': 3})
+        sub = Subscription.objects.get(pk=self.sub.pk)
+        self.assertEqual(sub.get_adjusted_product_class().name, 'FreePlan')
+        self.assertEqual(billing.quotas.get_limit(self.a, 'Projects'), 3)
+    def test_adjusted_classes_shared(self):
+        from django.contrib.auth.models import User
+        sub2 = User.objects.create_user('u2', 'u2@x.com').billing_account  \
+            .subscribe_to_product('FreePlan')
+        self.adjust(self.inclusion, {'Projects': 3})
+        self.adjust(self.inclusion, {'Projects': 3}, sub=sub2)
+        sub = Subscription.objects.get(pk=self.sub.pk)
+        sub2 = Subscription.objects.get(pk=sub2.pk)
+        self.assertIs(sub.get_adjusted_product_class(),
+            sub2.get_adjusted_product_class())
+    def test_prefetch_adjustments(self):
+        self.adjust(self.discount, {'percent': 50})
+        sub = Subscription.objects.get(pk=self.sub.pk)
+        Subscription.objects.prefetch_adjustments([sub])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(sub.get_adjustments()), 1)
+    def test_billing_run(self):
+        from django.contrib.auth.models import User
+        a2 = User.objects.create_user('u2', 'u2@x.com').billing_account
+        iou_account = IOUAccount.objects.create(billing_account=a2)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
+        sub = a2.subscribe_to_product('SilverPlan')
+        self.adjust(self.discount, {'percent': 20}, sub=sub)
+        Subscription.objects.filter(pk=sub.pk).update(
+            date_created=datetime.datetime(2011, 12, 1))
+        run = billing.invoicing.run_billing(
+            datetime.date(2012, 1, 1), datetime.date(2012, 1, 31))
+        self.assertEqual(
+            run.invoices.get(billing_account=a2).total, Decimal('60.00'))
 
 class CacheTests(TestCase):
     def setUp(self):
@@ -234,6 +973,12 @@ class CacheTests(TestCase):
         
     def test_get_product(self):
         self.assertEqual(loading.get_product('GoldPlan'), billing_defs.GoldPlan)
+    def test_catalog_version(self):
+        version = loading.get_catalog_version()
+        self.assertEqual(version, loading.get_catalog_version())
+        loading.product_cache = OrderedDict(
+            (p.name, p) for p in [billing_defs.FreePlan, billing_defs.GoldPlan])
+        self.assertNotEqual(loading.get_catalog_version(), version)
     def test_get_products(self):
         plans = set([
             billing_defs.GoldPlan,
@@ -313,6 +1058,30 @@ class CacheTests(TestCase):
         ]
         self.assertListEqual(plans, loading.get_products(hidden=True))
 
+class LazyLoadingTests(TestCase):
+    def setUp(self):
+        super(LazyLoadingTests, self).setUp()
+        self._old_products = loading.product_cache
+        self._old_processors = loading.processor_cache
+        loading.product_cache = None
+        loading.processor_cache = None
+    def tearDown(self):
+        super(LazyLoadingTests, self).tearDown()
+        loading.product_cache = self._old_products
+        loading.processor_cache = self._old_processors
+
+    def test_get_product_populates(self):
+        self.assertEqual(loading.get_product('GoldPlan'), billing_defs.GoldPlan)
+        self.assertIn('GoldPlan', loading.product_cache)
+    def test_get_processor_populates(self):
+        self.assertEqual(
+            loading.get_processor('default'), SimpleAccountBillingProcessor)
+        self.assertIn('default', loading.processor_cache)
+    def test_warm(self):
+        loading.warm()
+        self.assertIsNotNone(loading.product_cache)
+        self.assertIsNotNone(loading.processor_cache)
+
 class AllProductsTestCase(TestCase):
     def setUp(self):
         super(AllProductsTestCase, self).setUp()
@@ -343,6 +1112,11 @@ class HiddenProductTests(AllProductsTestCase):
     def test_get_products(self):
         self.assertNotIn(product_defs.SecretPlan, loading.get_products())
         self.assertIn(product_defs.SecretPlan, loading.get_products(hidden=True))
+    def test_catalog_index_follows_product_cache(self):
+        index = loading.get_catalog_index()
+        self.assertIs(index.source, loading.product_cache)
+        self.assertEqual(index.get_rank(product_defs.SecretPlan), 5)
+        self.assertRaises(ValueError, index.get_rank, billing_defs.SecretFreePlan)
     def test_producttype(self):
         billing.management.update_all_producttypes(verbosity=0)
         pt = ProductType.objects.get_for_product(product_defs.SecretPlan)
@@ -364,7 +1138,20 @@ class BillingOverviewViewTests(BaseViewTestCase):
             billing_defs.GoldPlan,
         ]
         self.assertListEqual(list(r.context['products']), list(products))
-        
+    def test_plan_grid_cached(self):
+        r = self.client.get('/')
+        self.assertTrue('/subscription/GoldPlan/' in r.context['plan_grid'])
+        key = billing.views.get_plan_grid_cache_key(r.context['products'], None)
+        self.assertEqual(cache.get(key), r.context['plan_grid'])
+        cache.set(key, 'cached grid')
+        r = self.client.get('/')
+        self.assertEqual(r.context['plan_grid'], 'cached grid')
+    def test_plan_grid_keyed_by_current_product(self):
+        self.u.billing_account.subscribe_to_product('FreePlan')
+        r = self.client.get('/')
+        self.assertTrue('Current plan' in r.context['plan_grid'])
+        self.assertFalse('/subscription/FreePlan/' in r.context['plan_grid'])
+
 class SubscriptionViewTests(BaseViewTestCase):
     def test_dispatch_not_logged_in(self):
         from django.contrib.auth.models import AnonymousUser
@@ -464,9 +1251,36 @@ class SubscriptionViewTests(BaseViewTestCase):
         self.assertEqual(r.status_code, 200)
 
 class BillingHistoryViewTests(BaseViewTestCase):
+    def setUp(self):
+        super(BillingHistoryViewTests, self).setUp()
+        a = self.u.billing_account
+        self.subs = [a.subscribe_to_product(p)
+            for p in ('FreePlan', 'SecretFreePlan', 'GoldPlan')]
+        self.subs.reverse()
     def test_fetch(self):
         r = self.client.get('/history/')
         self.assertEqual(r.status_code, 200)
+        self.assertEqual(list(r.context['subscriptions']), self.subs)
+        self.assertIsNone(r.context['next_cursor'])
+    def test_history_pages(self):
+        a = self.u.billing_account
+        with self.assertNumQueries(2):
+            page, cursor = Subscription.objects.get_history_page(a, page_size=2)
+            statuses = [[s.status for s in sub.approval_statuses.all()]
+                for sub in page]
+        self.assertEqual(page, self.subs[:2])
+        self.assertEqual(statuses, [['pending', 'declined'], ['pending', 'approved']])
+        page, cursor = Subscription.objects.get_history_page(
+            a, cursor, page_size=2)
+        self.assertEqual(page, self.subs[2:])
+        self.assertIsNone(cursor)
+    def test_bad_cursor(self):
+        r = self.client.get('/history/?before=nonsense')
+        self.assertEqual(r.status_code, 404)
+        r = self.client.get('/history/?before=99999999999999999999.1')
+        self.assertEqual(r.status_code, 404)
+        r = self.client.get('/history/?before=1.99999999999999999999')
+        self.assertEqual(r.status_code, 404)
 
 class BillingDetailsViewTests(BaseViewTestCase):
     def test_products_asc_desc(self):
@@ -483,16 +1297,283 @@ class ProductChangeTypeTests(UserTestCase):
             billing_tags.product_change_type(billing_defs.FreePlan, self.u),
             'upgrade',
         )
+    def test_change_type(self):
+        silver = billing_defs.SilverPlan
+        self.assertEqual(
+            loading.get_product_change_type(silver, billing_defs.GoldPlan),
+            'upgrade')
+        self.assertEqual(
+            loading.get_product_change_type(silver, billing_defs.BronzePlan),
+            'downgrade')
+        self.assertIsNone(loading.get_product_change_type(silver, silver))
+    def test_change_types(self):
+        self.u.billing_account.subscribe_to_product('FreePlan')
+        self.assertEqual(
+            billing_tags.product_change_types(loading.get_products(), self.u),
+            [
+                (billing_defs.FreePlan, None),
+                (billing_defs.BronzePlan, 'upgrade'),
+                (billing_defs.SilverPlan, 'upgrade'),
+                (billing_defs.GoldPlan, 'upgrade'),
+            ]
+        )
 
-class ProcessorTests(TestCase):
+class ProcessorTests(UserTestCase):
     def setUp(self):
-        pass
+        super(ProcessorTests, self).setUp()
+        from django.contrib.auth.models import User
+        self.a = self.u.billing_account
+        self.a2 = User.objects.create_user('u2', 'u2@x.com').billing_account
+        iou_account = IOUAccount.objects.create(billing_account=self.a2)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=False)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
         
     def tearDown(self):
-        pass
+        stub_gateway.gateway = stub_gateway.StubGateway()
         
     def test_init(self):
         pass
+    def test_has_valid_billing_details_many(self):
+        with self.assertNumQueries(1):
+            valid = SimpleAccountBillingProcessor.has_valid_billing_details_many(
+                [self.a, self.a2])
+        self.assertEqual(valid, {self.a.pk: False, self.a2.pk: True})
+    def test_routed_has_valid_billing_details_many(self):
+        from billing.processor.utils import has_valid_billing_details_many
+        self.assertEqual(
+            has_valid_billing_details_many([self.a, self.a2]),
+            {self.a.pk: False, self.a2.pk: True})
+    def test_billing_details_cached(self):
+        self.assertTrue(self.a2.has_valid_billing_details())
+        with self.assertNumQueries(0):
+            self.assertTrue(self.a2.has_valid_billing_details())
+            self.assertEqual(
+                SimpleAccountBillingProcessor.has_valid_billing_details_many(
+                    [self.a2]),
+                {self.a2.pk: True})
+    def test_billing_details_cache_invalidated(self):
+        self.assertFalse(self.a.has_valid_billing_details())
+        iou_account = IOUAccount.objects.create(billing_account=self.a)
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=True)
+        self.assertTrue(self.a.has_valid_billing_details())
+        AccountIOU.objects.create(iou_account=iou_account, has_agreed_to_pay=False)
+        self.assertFalse(self.a.has_valid_billing_details())
+    def test_latest_iou_denormalized(self):
+        iou_account = IOUAccount.objects.get(billing_account=self.a2)
+        latest = AccountIOU.objects.filter(iou_account=iou_account).latest()
+        self.assertTrue(iou_account.has_agreed_to_pay)
+        self.assertEqual(iou_account.latest_iou_created, latest.created)
+    def test_delete_user_with_ious(self):
+        self.assertTrue(self.a2.has_valid_billing_details())
+        self.a2.owner.delete()
+        self.assertFalse(IOUAccount.objects.exists())
+        self.assertFalse(AccountIOU.objects.exists())
+        self.assertFalse(SimpleAccountBillingProcessor.has_valid_billing_details(
+            Account(pk=self.a2.pk)))
+    def test_has_valid_billing_details_single_query(self):
+        account = Account.objects.get(pk=self.a2.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(SimpleAccountBillingProcessor.has_valid_billing_details(account))
+    def test_remote_billing_details_cached(self):
+        stub_gateway.gateway = stub_gateway.StubGateway([self.a.pk], latency=0)
+        processor = stub_gateway.CachedStubGatewayBillingProcessor
+        self.assertTrue(processor.has_valid_billing_details(self.a))
+        self.assertTrue(processor.has_valid_billing_details(self.a))
+        self.assertEqual(stub_gateway.gateway.calls, 1)
+    def test_default_many_falls_back_to_single(self):
+        stub_gateway.gateway = stub_gateway.StubGateway([2], latency=0)
+        accounts = [Account(pk=i) for i in range(1, 4)]
+        processor = stub_gateway.StubGatewayBillingProcessor
+        self.assertEqual(processor.has_valid_billing_details_many(accounts),
+            {1: False, 2: True, 3: False})
+        self.assertEqual(stub_gateway.gateway.calls, 3)
+    def test_concurrently(self):
+        stub_gateway.gateway = stub_gateway.StubGateway(range(0, 40, 2))
+        accounts = [Account(pk=i) for i in range(40)]
+        processor = stub_gateway.StubGatewayBillingProcessor
+        valid = processor.has_valid_billing_details_concurrently(
+            accounts, max_workers=8)
+        self.assertEqual(valid, dict((i, i % 2 == 0) for i in range(40)))
+        self.assertTrue(1 < stub_gateway.gateway.max_in_flight <= 8)
+    def test_concurrently_closes_connections(self):
+        import threading
+        checked = []
+        closed = []
+        class QueryingProcessor(stub_gateway.StubGatewayBillingProcessor):
+            @classmethod
+            def has_valid_billing_details(cls, account):
+                from django.db import connections
+                connections['default'].cursor()
+                checked.append(threading.current_thread())
+                return True
+        # the :memory: test database's close() does nothing, so record the
+        # calls instead
+        from django.db import connections
+        wrapper_class = type(connections['default'])
+        close = wrapper_class.close
+        def recording_close(conn):
+            if conn.alias == 'default':
+                closed.append(threading.current_thread())
+            return close(conn)
+        wrapper_class.close = recording_close
+        try:
+            accounts = [Account(pk=i) for i in range(4)]
+            valid = QueryingProcessor.has_valid_billing_details_concurrently(
+                accounts, max_workers=2)
+        finally:
+            wrapper_class.close = close
+        self.assertEqual(valid, dict((i, True) for i in range(4)))
+        self.assertEqual(len(checked), 4)
+        # once per worker's share of the accounts, not once per account
+        self.assertEqual(len(closed), 2)
+        self.assertEqual(set(closed), set(checked))
+        self.assertNotIn(threading.current_thread(), closed)
+
+class CountingRouter(object):
+    """ routes even account pks to 'even', counting the decisions made """
+    instances = 0
+    def __init__(self):
+        CountingRouter.instances += 1
+        self.calls = 0
+    def get_processor_for_account(self, account):
+        self.calls += 1
+        if account.pk % 2 == 0:
+            return 'even'
+
+class MasterProcessorRouterTests(unittest.TestCase):
+    def setUp(self):
+        CountingRouter.instances = 0
+        self.router = MasterProcessorRouter(
+            ['billing.tests.CountingRouter'], cache_size=2)
+    def test_routers_instantiated_once(self):
+        self.assertEqual(CountingRouter.instances, 0)
+        self.router.get_processor_name_for_account(Account(pk=1))
+        self.router.get_processor_name_for_account(Account(pk=2))
+        self.assertEqual(CountingRouter.instances, 1)
+    def test_routes(self):
+        self.assertEqual(
+            self.router.get_processor_name_for_account(Account(pk=1)), 'default')
+        self.assertEqual(
+            self.router.get_processor_name_for_account(Account(pk=2)), 'even')
+    def test_routes_cached(self):
+        for i in range(3):
+            self.router.get_processor_name_for_account(Account(pk=1))
+        self.assertEqual(self.router.routers[0].calls, 1)
+        self.router.invalidate(1)
+        self.router.get_processor_name_for_account(Account(pk=1))
+        self.assertEqual(self.router.routers[0].calls, 2)
+    def test_least_recently_used_evicted(self):
+        for pk in (1, 2, 1, 3):
+            self.router.get_processor_name_for_account(Account(pk=pk))
+        self.assertTrue(1 in self.router.route_cache)
+        self.assertFalse(2 in self.router.route_cache)
+    def test_get_processor_names_for_accounts(self):
+        accounts = [Account(pk=pk) for pk in range(1, 5)]
+        self.assertEqual(self.router.get_processor_names_for_accounts(accounts),
+            {'default': accounts[0::2], 'even': accounts[1::2]})
+
+@override_settings(BILLING_REPLICA_DATABASES=('replica',))
+class ReplicaRouterTests(UserTestCase):
+    def setUp(self):
+        super(ReplicaRouterTests, self).setUp()
+        self.router = billing.replicas.BillingReplicaRouter()
+        billing.replicas.unpin()
+    def tearDown(self):
+        billing.replicas.unpin()
+    def test_db_for_read(self):
+        from django.contrib.auth.models import User
+        self.assertEqual(self.router.db_for_read(Subscription), 'replica')
+        self.assertEqual(self.router.db_for_read(IOUAccount), 'replica')
+        self.assertIsNone(self.router.db_for_read(User))
+    def test_write_pins_to_primary(self):
+        self.assertEqual(self.router.db_for_write(Subscription), 'default')
+        self.assertTrue(billing.replicas.has_written())
+        self.assertEqual(self.router.db_for_read(Subscription), 'default')
+        billing.replicas.unpin()
+        self.assertEqual(self.router.db_for_read(Subscription), 'replica')
+    def test_write_of_instance_read_from_replica(self):
+        from django.contrib.auth.models import User
+        self.u._state.db = 'replica'
+        self.assertEqual(self.router.db_for_write(User, instance=self.u), 'default')
+        self.assertFalse(billing.replicas.has_written())
+    def test_allow_relation(self):
+        account = Account(pk=1)
+        account._state.db = 'replica'
+        self.assertTrue(self.router.allow_relation(account, self.u))
+    def test_allow_syncdb(self):
+        self.assertFalse(self.router.allow_syncdb('replica', Subscription))
+        self.assertIsNone(self.router.allow_syncdb('default', Subscription))
+    @override_settings(BILLING_REPLICA_DATABASES=('default',))
+    def test_subscribe_pins_to_primary(self):
+        from django.db import router
+        router.routers.insert(0, self.router)
+        try:
+            self.u.billing_account.subscribe_to_product('GoldPlan')
+        finally:
+            router.routers.remove(self.router)
+        self.assertTrue(billing.replicas.is_pinned())
+    def test_middleware_pins_session(self):
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+        middleware = billing.replicas.BillingReplicaMiddleware()
+        request = RequestFactory().get('/')
+        request.session = {}
+        middleware.process_request(request)
+        self.assertFalse(billing.replicas.is_pinned())
+        self.router.db_for_write(Subscription)
+        middleware.process_response(request, HttpResponse())
+        self.assertFalse(billing.replicas.is_pinned())
+        middleware.process_request(request)
+        self.assertTrue(billing.replicas.is_pinned())
+        other_request = RequestFactory().get('/')
+        other_request.session = {}
+        middleware.process_request(other_request)
+        self.assertFalse(billing.replicas.is_pinned())
+        request.session[billing.replicas.SESSION_KEY] = 0
+        middleware.process_request(request)
+        self.assertFalse(billing.replicas.is_pinned())
+
+@override_settings(BILLING_REPLICA_DATABASES=('replica',))
+class ReplicaDatabaseTests(UserTestCase):
+    """ routes reads to the second SQLite database of the test settings """
+    multi_db = True
+    def setUp(self):
+        super(ReplicaDatabaseTests, self).setUp()
+        from django.db import router
+        # the replica has caught up with the catalog, but nothing else
+        ProductType.objects.using('replica').bulk_create([
+            ProductType(pk=pt.pk, name=pt.name)
+            for pt in ProductType.objects.using('default')])
+        self.router = billing.replicas.BillingReplicaRouter()
+        router.routers.insert(0, self.router)
+        billing.replicas.unpin()
+    def tearDown(self):
+        from django.db import router
+        router.routers.remove(self.router)
+        billing.replicas.unpin()
+    def test_reads_your_writes(self):
+        account = Account.objects.create(owner=self.u)
+        self.assertEqual(account._state.db, 'default')
+        billing.replicas.unpin()
+        # unpinned, reads go to the replica, which hasn't seen the account
+        self.assertFalse(Account.objects.filter(pk=account.pk).exists())
+        account.subscribe_to_product('FreePlan')
+        self.assertTrue(billing.replicas.is_pinned())
+        # after writing, reads go to the primary and see the writes
+        account = Account.objects.get(pk=account.pk)
+        self.assertEqual(account._state.db, 'default')
+        self.assertEqual(
+            account.get_current_product_class(), billing_defs.FreePlan)
+    def test_bulk_subscribe_reads_new_rows_from_primary(self):
+        account = Account.objects.create(owner=self.u)
+        billing.replicas.unpin()
+        # the (locked) product type and the last pk before the insert are
+        # read from the primary
+        with self.assertNumQueries(0, using='replica'):
+            subs = Subscription.objects.bulk_create_from_product(
+                'FreePlan', [account])
+        self.assertEqual(len(subs), 1)
+        self.assertEqual(subs[0]._state.db, 'default')
 
 ### Management Command Tests ###
 
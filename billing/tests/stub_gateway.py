@@ -0,0 +1,44 @@
+"""
+A stand-in for a remote payment gateway, for testing processors which
+verify billing details over the network
+"""
+
+import threading
+import time
+
+from billing.processor.api import BillingProcessor, BillingDetailsCache
+
+class StubGateway(object):
+    """ answers billing details lookups after a fixed delay """
+    def __init__(self, valid_account_ids=(), latency=0.02):
+        self.valid_account_ids = set(valid_account_ids)
+        self.latency = latency
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+    def has_valid_billing_details(self, account_id):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            return account_id in self.valid_account_ids
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+gateway = StubGateway()
+
+class StubGatewayBillingProcessor(BillingProcessor):
+    @staticmethod
+    def has_valid_billing_details(account):
+        return gateway.has_valid_billing_details(account.pk)
+
+# remote details can change without us hearing about it, so cache briefly
+details_cache = BillingDetailsCache('stub_gateway', timeout=60)
+
+class CachedStubGatewayBillingProcessor(StubGatewayBillingProcessor):
+    has_valid_billing_details = staticmethod(details_cache.cached(
+        StubGatewayBillingProcessor.has_valid_billing_details))
@@ -0,0 +1,180 @@
+"""
+Incrementally maintained usage counts
+
+Rather than counting a feature's rows every time a quota is checked,
+register the model whose instances use up the feature:
+
+    billing.usage.register(Project, 'Projects')
+
+Each saved or deleted Project then adjusts its account's UsageCounter with
+an atomic update, so get_usage() is a single indexed read. If a model is
+registered after rows already exist, run the `reconcile_usage_counters`
+management command to recount from scratch.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, signals
+
+import billing.quotas
+from billing.utils import commit_on_success_unless_managed
+
+# feature name -> (model, name of the model's billing account field)
+registry = {}
+
+def get_feature_name(feature):
+    if isinstance(feature, basestring):
+        return feature
+    return feature.__name__
+
+def register(model, feature, account_field='account'):
+    """
+    counts each instance of `model` as one unit of `feature` used by the
+    billing account its `account_field` foreign key points to
+    """
+    feature = get_feature_name(feature)
+    if feature in registry:
+        registered_model = registry[feature][0]
+        if registered_model._meta.db_table != model._meta.db_table:
+            raise ValueError('"%s" is already being counted' % feature)
+    registry[feature] = (model, account_field)
+    attname = model._meta.get_field(account_field).attname
+    def count_created(instance, created, **kwargs):
+        if created:
+            increment(getattr(instance, attname), feature)
+    def count_deleted(instance, **kwargs):
+        # never creates a counter: when the account itself is being deleted,
+        # this runs once the account (and its counters) are already gone
+        increment(getattr(instance, attname), feature, -1, create=False)
+    # weak=False since the receivers are local to this function
+    uid = 'billing.usage:%s' % feature
+    signals.post_save.connect(
+        count_created, sender=model, weak=False, dispatch_uid=uid)
+    signals.post_delete.connect(
+        count_deleted, sender=model, weak=False, dispatch_uid=uid)
+
+def increment(account, feature, n=1, update_cache=True, create=True):
+    """
+    atomically adds `n` (which may be negative) to an account's usage, and
+    to the usage cached by billing.quotas unless `update_cache` is False
+
+    Unless `create` is True, an account without a counter is left alone.
+    """
+    from billing.models import UsageCounter
+    account_id = getattr(account, 'pk', account)
+    feature = get_feature_name(feature)
+    counters = UsageCounter.objects.filter(
+        billing_account=account_id, feature=feature)
+    if not counters.update(count=F('count') + n):
+        if not create:
+            return
+        # no counter yet; if another process creates it first, update that one
+        sid = transaction.savepoint()
+        try:
+            UsageCounter.objects.create(
+                billing_account_id=account_id, feature=feature, count=n)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            counters.update(count=F('count') + n)
+        else:
+            transaction.savepoint_commit(sid)
+    # only once the change is recorded, so a failed write doesn't leave the
+    # cached usage ahead of the database
+    if update_cache:
+        billing.quotas.usage_changed(account_id, feature, n)
+
+def increment_within(account, feature, limit, n=1):
+    """
+    atomically adds `n` to an account's usage if that keeps it within
+    `limit`. Returns whether it was added.
+
+    The cached usage is left alone, so callers should update it themselves.
+    """
+    from billing.models import UsageCounter
+    account_id = getattr(account, 'pk', account)
+    feature = get_feature_name(feature)
+    counters = UsageCounter.objects.filter(
+        billing_account=account_id, feature=feature)
+    if counters.filter(count__lte=limit - n).update(count=F('count') + n):
+        return True
+    if n > limit or counters.exists():
+        return False
+    # no counter yet; if another process creates it first, check that one
+    sid = transaction.savepoint()
+    try:
+        UsageCounter.objects.create(
+            billing_account_id=account_id, feature=feature, count=n)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return bool(counters.filter(count__lte=limit - n).update(
+            count=F('count') + n))
+    transaction.savepoint_commit(sid)
+    return True
+
+def get_usage(account, feature):
+    """ returns the number of units of `feature` the account is using """
+    from billing.models import UsageCounter
+    account_id = getattr(account, 'pk', account)
+    counts = UsageCounter.objects.filter(
+        billing_account=account_id, feature=get_feature_name(feature),
+    ).values_list('count', flat=True)
+    r = list(counts[:1])
+    if r:
+        return r[0]
+    return 0
+
+def reconcile(features=None, batch_size=1000):
+    """
+    recounts the given registered features (by default, all of them) from
+    their models, a batch of accounts at a time
+
+    Returns the number of counters which were corrected.
+    """
+    from billing.models import Account
+    if features is None:
+        features = registry.keys()
+    corrected = 0
+    for feature in features:
+        feature = get_feature_name(feature)
+        if feature not in registry:
+            raise ValueError('"%s" is not a counted feature' % feature)
+        account_ids = Account.objects.order_by('pk').values_list('pk', flat=True)
+        last_pk = 0
+        while True:
+            batch = list(account_ids.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            corrected_ids = _reconcile_batch(feature, batch)
+            # once the batch is committed, so the usage isn't re-cached
+            # from the old counts
+            billing.quotas.usage_reset(corrected_ids, feature)
+            corrected += len(corrected_ids)
+    return corrected
+
+@commit_on_success_unless_managed()
+def _reconcile_batch(feature, account_ids):
+    from django.db.models import Count
+    from billing.models import UsageCounter
+    model, account_field = registry[feature]
+    actual = dict(model._default_manager
+        .filter(**{'%s__in' % account_field: account_ids})
+        .order_by().values_list(account_field)
+        .annotate(count=Count('pk')))
+    counters = dict((c.billing_account_id, c) for c in
+        UsageCounter.objects.filter(
+            feature=feature, billing_account__in=account_ids))
+    new_counters = []
+    corrected = []
+    for account_id in account_ids:
+        count = actual.get(account_id, 0)
+        counter = counters.get(account_id)
+        if counter is None:
+            if count:
+                new_counters.append(UsageCounter(
+                    billing_account_id=account_id, feature=feature, count=count))
+                corrected.append(account_id)
+        elif counter.count != count:
+            UsageCounter.objects.filter(pk=counter.pk).update(count=count)
+            corrected.append(account_id)
+    UsageCounter.objects.bulk_create(new_counters)
+    return corrected
@@ -0,0 +1,106 @@
+import datetime
+import threading
+from functools import wraps
+from itertools import islice
+
+from django.db import transaction
+from ordereddict import OrderedDict
+
+def chunked(iterable, size):
+    """ yields lists of up to `size` consecutive items from `iterable` """
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+class commit_on_success_unless_managed(object):
+    """
+    like transaction.commit_on_success, but if the caller is already
+    managing a transaction, runs in it rather than committing it. Use as
+    `@commit_on_success_unless_managed()` or in a `with` statement
+    """
+    def __init__(self, using=None):
+        self.using = using
+        self.transaction = None
+    def __enter__(self):
+        if not transaction.is_managed(using=self.using):
+            self.transaction = transaction.commit_on_success(using=self.using)
+            self.transaction.__enter__()
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.transaction is not None:
+            entered, self.transaction = self.transaction, None
+            return entered.__exit__(exc_type, exc_value, traceback)
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with commit_on_success_unless_managed(self.using):
+                return func(*args, **kwargs)
+        return inner
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_cursor(timestamp, pk):
+    """
+    returns an opaque keyset pagination cursor for a row ordered by
+    (timestamp, pk)
+    """
+    delta = timestamp.replace(tzinfo=None) - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+    return '%d.%d' % (micros, pk)
+
+def decode_cursor(cursor):
+    """
+    returns the (timestamp, pk) pair encoded by encode_cursor(). Raises
+    ValueError for malformed cursors
+    """
+    micros, pk = cursor.split('.')
+    micros, pk = int(micros), int(pk)
+    if not 0 < pk < 2 ** 63:
+        raise ValueError('Cursor primary key out of range')
+    try:
+        return EPOCH + datetime.timedelta(microseconds=micros), pk
+    except OverflowError:
+        raise ValueError('Cursor timestamp out of range')
+
+class LRUCache(object):
+    """
+    a thread-safe mapping that holds at most `max_size` items, discarding
+    the least recently used item first
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    def __len__(self):
+        return len(self._data)
+    def __contains__(self, key):
+        return key in self._data
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+def decode_bitmap(value):
+    """ returns the integer bitmap stored as a hex string by encode_bitmap() """
+    return int(value, 16) if value else 0
+
+def encode_bitmap(bitmap):
+    return '%x' % bitmap if bitmap else ''
@@ -0,0 +1,155 @@
+"""
+Vectorized pricing of many accounts at once (requires numpy)
+
+The pricing schemes of a set of products are compiled into integer arrays,
+so the charges for a whole usage matrix (accounts x features) come out of a
+few array operations rather than a Python loop over every account and
+feature. Prices are held as integer ten-thousandths of a currency unit and
+each line (the base price and each feature's charge) is rounded half-up to
+cents with integer arithmetic, just as invoice line items are, so the
+results are exactly what billing.invoicing would charge.
+
+    catalog = CompiledCatalog(billing.loading.get_products(hidden=True))
+    totals = catalog.price(product_indices, usage)
+
+price_accounts() does the same for a queryset of accounts, using their
+current (adjusted) products and usage counters.
+"""
+
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from billing.features import get_features, get_inclusion_limits, get_unit_prices
+from billing.utils import chunked
+
+# prices are scaled to integers in units of 1/PRICE_SCALE
+PRICE_SCALE = 10000
+CENT_SCALE = PRICE_SCALE // 100
+
+def _scale(price):
+    scaled = Decimal(str(price)) * PRICE_SCALE
+    if scaled != scaled.to_integral_value():
+        raise ValueError(
+            '%s has more precision than can be priced exactly' % price)
+    return int(scaled)
+
+def _to_cents(scaled):
+    """ rounds scaled prices half up to cents (they're never negative) """
+    return (scaled + CENT_SCALE // 2) // CENT_SCALE
+
+class CompiledCatalog(object):
+    """ the pricing schemes of a list of product classes, as arrays """
+    def __init__(self, product_classes, features=None):
+        if numpy is None:
+            raise ImportError('vectorized pricing requires numpy')
+        self.products = list(product_classes)
+        self.product_index = dict((p, i) for i, p in enumerate(self.products))
+        if features is None:
+            features = sorted(set(name for p in self.products
+                for name, feature in get_features(p)))
+        self.features = list(features)
+        self.feature_index = dict((f, i) for i, f in enumerate(self.features))
+        shape = (len(self.products), len(self.features))
+        self.base_prices = numpy.zeros(len(self.products), dtype=numpy.int64)
+        self.unit_prices = numpy.zeros(shape, dtype=numpy.int64)
+        self.included = numpy.zeros(shape, dtype=numpy.int64)
+        # whether each feature of each product is priced by inclusion
+        self.limited = numpy.zeros(shape, dtype=bool)
+        for i, product_class in enumerate(self.products):
+            self.base_prices[i] = _scale(product_class.base_price)
+            for name, price in get_unit_prices(product_class).items():
+                if name in self.feature_index:
+                    self.unit_prices[i, self.feature_index[name]] = _scale(price)
+            for name, included in get_inclusion_limits(product_class).items():
+                if name in self.feature_index:
+                    self.included[i, self.feature_index[name]] = included
+                    self.limited[i, self.feature_index[name]] = True
+    def price_cents(self, product_indices, usage):
+        """
+        returns an array of the charges, in cents, for N accounts
+
+        `product_indices` is a length N sequence of indexes into
+        self.products and `usage` an N x len(self.features) array of the
+        units of each feature each account used.
+        """
+        product_indices = numpy.asarray(product_indices, dtype=numpy.intp)
+        usage = numpy.asarray(usage, dtype=numpy.int64)
+        lines = usage * self.unit_prices[product_indices]
+        return _to_cents(self.base_prices[product_indices]) +  \
+            _to_cents(lines).sum(axis=1)
+    def price(self, product_indices, usage):
+        """ as price_cents(), but returns a list of Decimals """
+        cents = self.price_cents(product_indices, usage)
+        return [Decimal(int(c)).scaleb(-2) for c in cents]
+    def get_overages(self, product_indices, usage):
+        """
+        returns an N x len(self.features) array of the units each account
+        uses beyond what its product includes (zero for features which
+        aren't priced with a FixedInclusion)
+        """
+        product_indices = numpy.asarray(product_indices, dtype=numpy.intp)
+        usage = numpy.asarray(usage, dtype=numpy.int64)
+        over = numpy.maximum(usage - self.included[product_indices], 0)
+        return numpy.where(self.limited[product_indices], over, 0)
+
+def get_usage_matrix(account_ids, features):
+    """
+    returns a len(account_ids) x len(features) array of the accounts' usage
+    counters, loaded with one query per 500 accounts
+    """
+    from billing.models import UsageCounter
+    row = dict((a, i) for i, a in enumerate(account_ids))
+    column = dict((f, i) for i, f in enumerate(features))
+    usage = numpy.zeros((len(row), len(column)), dtype=numpy.int64)
+    for chunk in chunked(account_ids, 500):
+        counters = UsageCounter.objects  \
+            .filter(billing_account__in=chunk, feature__in=features)  \
+            .values_list('billing_account', 'feature', 'count')
+        for account_id, feature, count in counters:
+            usage[row[account_id], column[feature]] = count
+    return usage
+
+def price_accounts(accounts, catalog=None, product_class=None):
+    """
+    returns a dict mapping account pks to the charge for one period, for
+    each of the given accounts (as returned by
+    Account.objects.with_current_product()) which has a current product
+
+    Pass `product_class` to price every account as if it were subscribed
+    to that product instead.
+    """
+    import billing.loading
+    from billing.models import Subscription
+    if catalog is None:
+        catalog = CompiledCatalog(billing.loading.get_products(hidden=True))
+    accounts = list(accounts)
+    if product_class is None:
+        subs = [account.get_current_subscription() for account in accounts]
+        Subscription.objects.prefetch_adjustments([s for s in subs if s])
+        default_product = billing.loading.get_default_product()
+        product_classes = [sub.get_adjusted_product_class() if sub
+            else default_product for sub in subs]
+    else:
+        product_classes = [product_class] * len(accounts)
+    # adjusted products are compiled alongside the catalog's own
+    extra = []
+    for pc in product_classes:
+        if pc is not None and pc not in catalog.product_index  \
+                and pc not in extra:
+            extra.append(pc)
+    if extra:
+        catalog = CompiledCatalog(catalog.products + extra, catalog.features)
+    account_ids = []
+    product_indices = []
+    for account, pc in zip(accounts, product_classes):
+        if pc is not None:
+            account_ids.append(account.pk)
+            product_indices.append(catalog.product_index[pc])
+    if not account_ids:
+        return {}
+    usage = get_usage_matrix(account_ids, catalog.features)
+    return dict(zip(account_ids, catalog.price(product_indices, usage)))
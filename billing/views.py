@@ -1,6 +1,10 @@
 from django.views.generic import TemplateView, FormView
 from django.core.urlresolvers import reverse
+from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 
 import billing.loading
 import billing.processor
@@ -8,6 +12,39 @@ from billing.forms import SubscriptionConfirmationForm
 from billing.models import Subscription, ProductType
 
 
+PLAN_GRID_CACHE_TIMEOUT = getattr(settings,
+    'BILLING_PLAN_GRID_CACHE_TIMEOUT', 60 * 60)
+
+def get_plan_grid_cache_key(products, current_product):
+    return 'billing:plan_grid:%s:%s:%s' % (
+        billing.loading.get_catalog_version(),
+        billing.loading.get_products_fingerprint(products),
+        current_product.name if current_product else '')
+
+def render_plan_grid(products, current_product,
+        template_name='billing/plan_grid.html'):
+    """
+    returns the rendered plan grid for the given visible products and
+    current product
+
+    The grid is the same for every account with the same visible products
+    and current product, so it is cached under those (and the catalog
+    version). It is rendered without the request's context, so it must
+    not depend on anything else.
+    """
+    key = get_plan_grid_cache_key(products, current_product)
+    html = cache.get(key)
+    if html is None:
+        html = render_to_string(template_name, {
+            'products': products,
+            'current_product': current_product,
+            'product_change_types': billing.loading.get_product_change_types(
+                current_product, products),
+        })
+        cache.set(key, html, PLAN_GRID_CACHE_TIMEOUT)
+    return mark_safe(html)
+
+
 class BillingOverviewView(TemplateView):
     """
     presents a list/descriptions of the different products on offer
@@ -16,6 +53,9 @@ class BillingOverviewView(TemplateView):
     or downgrade their current subscription.
     """
     template_name = 'billing/overview.html'
+    # rendered once per catalog version, visible set and current product and
+    # cached (see render_plan_grid()); None to leave the grid to the template
+    plan_grid_template_name = 'billing/plan_grid.html'
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
         context = super(BillingOverviewView, self).get_context_data(**kwargs)
@@ -23,10 +63,13 @@ class BillingOverviewView(TemplateView):
         context['all_products'] = billing.loading.get_products(hidden=True)
         context['public_products'] = billing.loading.get_products()
         billing_account = self.request.user.billing_account
+        billing_state = billing_account.get_billing_state()
         context['billing_account'] = billing_account
-        context['products'] = billing_account.get_visible_products()
-        current_product = billing_account.get_current_product_class()
-        context['current_product'] = current_product
+        context['products'] = billing_state.visible_products
+        context['current_product'] = billing_state.current_product_class
+        if self.plan_grid_template_name:
+            context['plan_grid'] = render_plan_grid(context['products'],
+                context['current_product'], self.plan_grid_template_name)
         return context
 
 class BaseBillingDetailsView(FormView):
@@ -112,14 +155,35 @@ class CurrentSubscriptionView(TemplateView):
     def get_context_data(self, **kwargs):
         # Call the base implementation first to get a context
         context = super(CurrentSubscriptionView, self).get_context_data(**kwargs)
-        cur_sub = self.request.user.billing_account.get_current_subscription()
+        billing_state = self.request.user.billing_account.get_billing_state()
+        cur_sub = billing_state.current_subscription
         context['current_subscription'] = cur_sub
         return context
 
 class BillingHistoryView(TemplateView):
+    """
+    Lists the user's subscriptions (newest first) along with their
+    approval statuses, a page at a time.
+
+    The next page is requested with `?before=<next_cursor>`.
+    """
     template_name = 'billing/history.html'
-    pass
-    
+    paginate_by = 20
+    def get_context_data(self, **kwargs):
+        # Call the base implementation first to get a context
+        context = super(BillingHistoryView, self).get_context_data(**kwargs)
+        billing_account = self.request.user.billing_account
+        try:
+            subscriptions, next_cursor = Subscription.objects.get_history_page(
+                billing_account, self.request.GET.get('before'),
+                self.paginate_by)
+        except ValueError:
+            raise Http404
+        context['billing_account'] = billing_account
+        context['subscriptions'] = subscriptions
+        context['next_cursor'] = next_cursor
+        return context
+
 
 def subscription_view(
     current_subscription_view=CurrentSubscriptionView.as_view(),
@@ -142,24 +206,25 @@ def subscription_view(
     confirmation_view
     """
     def dispatch(request, *args, **kwargs):
-        cur_product_cls = request.user.billing_account.get_current_product_class()
+        billing_state = request.user.billing_account.get_billing_state()
+        cur_product_cls = billing_state.current_product_class
         req_product_name = kwargs['product']
         try:
             req_product_cls = billing.loading.get_product(req_product_name)
         except ValueError:
             raise Http404
-        if req_product_cls not in request.user.billing_account.get_visible_products():
+        if req_product_cls not in billing_state.visible_products:
             raise Http404
         if cur_product_cls == req_product_cls:
             return current_subscription_view(request, *args, **kwargs)
         elif (
             req_product_cls.get_requires_payment_details()
-            and not request.user.billing_account.has_valid_billing_details()
+            and not billing_state.has_valid_billing_details
         ):
             return billing_details_view(request, *args, **kwargs)
         elif (
             not req_product_cls.get_requires_payment_details()
-            or request.user.billing_account.has_valid_billing_details()
+            or billing_state.has_valid_billing_details
         ):
             return confirmation_view(request, *args, **kwargs)
         else:
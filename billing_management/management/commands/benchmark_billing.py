@@ -0,0 +1,56 @@
+import json
+import platform
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from billing.benchmark import run_benchmarks, DEFAULT_SCALES
+
+class Command(BaseCommand):
+    help = "Benchmarks the billing ORM paths against synthetic data, which\n"  \
+    "is rolled back afterwards, and writes the results as JSON"
+    args = "[benchmark_name ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--scales',
+            default=','.join(str(s) for s in DEFAULT_SCALES),
+            help='Comma-separated numbers of accounts to generate'),
+        make_option('--subscriptions', type='int', default=2,
+            help='Number of subscriptions per account'),
+        make_option('--statuses', type='int', default=3,
+            help='Number of approval statuses per subscription'),
+        make_option('--sample-size', type='int', default=100,
+            help='Number of accounts to run the per-account benchmarks for'),
+        make_option('--output', default=None,
+            help='File to write the results to (default: stdout)'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(s) for s in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError('Scales must be comma-separated integers')
+        results = run_benchmarks(scales,
+            subscriptions_per_account=options['subscriptions'],
+            statuses_per_subscription=options['statuses'],
+            sample_size=options['sample_size'],
+            only=args or None)
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'results': results,
+        }
+        if options['output']:
+            out = open(options['output'], 'w')
+        else:
+            out = self.stdout
+        try:
+            json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            if out is not self.stdout:
+                out.close()
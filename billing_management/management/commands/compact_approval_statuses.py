@@ -0,0 +1,53 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing.archiving import compact_approval_statuses, CSVArchive,  \
+    DatabaseArchive, JSONLinesArchive
+
+class Command(BaseCommand):
+    help = "Moves subscription approval statuses older than the retention\n"  \
+    "window out of the status table, keeping each subscription's newest\n"  \
+    "status. Statuses are archived to the ArchivedApprovalStatus table\n"  \
+    "unless --archive-file is given"
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=365,
+            help='Number of days of history to keep'),
+        make_option('--archive-file', default=None,
+            help='File to append archived statuses to, instead of the '
+                'archive table'),
+        make_option('--format', choices=['jsonl', 'csv'], default='jsonl',
+            help='Format of the archive file'),
+        make_option('--batch-size', type='int', default=1000,
+            help='Number of statuses to move per transaction'),
+        make_option('--max-batches', type='int', default=None,
+            help='Stop after this many batches (run again to continue)'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError('--days must not be negative')
+        before = datetime.datetime.now() -  \
+            datetime.timedelta(days=options['days'])
+        f = None
+        if options['archive_file']:
+            try:
+                f = open(options['archive_file'], 'ab')
+            except IOError as e:
+                raise CommandError(str(e))
+            if options['format'] == 'csv':
+                archive = CSVArchive(f)
+            else:
+                archive = JSONLinesArchive(f)
+        else:
+            archive = DatabaseArchive()
+        try:
+            moved = compact_approval_statuses(before, archive,
+                batch_size=options['batch_size'],
+                max_batches=options['max_batches'])
+        finally:
+            if f is not None:
+                f.close()
+        self.stdout.write('\nArchived %s approval statuses created before %s\n\n'
+            % (moved, before))
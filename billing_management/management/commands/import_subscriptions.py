@@ -0,0 +1,52 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing.importing import import_subscriptions, read_csv, read_jsonl
+
+class Command(BaseCommand):
+    help = "Subscribes users to products in bulk, from a CSV file of\n"  \
+    "'user,product' rows or a JSONL file of {\"user\": ..., \"product\": ...}\n"  \
+    "objects. Users may be given by id or username. Reads stdin if the file\n"  \
+    "is '-'"
+    args = "<file>"
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=['csv', 'jsonl'], default=None,
+            help='Input format (default: guessed from the file extension, '
+                'or csv)'),
+        make_option('--chunk-size', type='int', default=1000,
+            help='Number of rows to import at once'),
+        make_option('--encoding', default='utf-8',
+            help='Encoding of a CSV file (default: utf-8)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Exactly one argument is needed: a file')
+        path = args[0]
+        format = options['format']
+        if format is None:
+            format = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+        if path == '-':
+            f = sys.stdin
+        else:
+            try:
+                f = open(path, 'rb')
+            except IOError as e:
+                raise CommandError(str(e))
+        if format == 'jsonl':
+            read_rows = read_jsonl
+        else:
+            read_rows = lambda f: read_csv(f, options['encoding'])
+        def on_failure(line, user, message):
+            self.stderr.write((u'Line %s (%s): %s\n' %
+                (line, user, message)).encode('utf-8'))
+        try:
+            imported, failed = import_subscriptions(read_rows(f),
+                chunk_size=options['chunk_size'], on_failure=on_failure)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        self.stdout.write('\nCreated %s subscriptions; %s rows failed\n\n' %
+            (imported, failed))
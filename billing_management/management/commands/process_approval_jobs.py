@@ -0,0 +1,31 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+import billing.approval
+
+class Command(BaseCommand):
+    help = "Requests approval of the subscriptions queued by\n"  \
+    "billing.approval.DatabaseApprovalBackend"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+            help='Number of jobs to claim at once'),
+        make_option('--loop', action='store_true', default=False,
+            help='Keep polling for new jobs instead of exiting once the '
+                'queue is empty'),
+        make_option('--interval', type='float', default=1.0,
+            help='Seconds to wait between polls of an empty queue'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            run, failed = billing.approval.process_approval_jobs(
+                batch_size=options['batch_size'])
+            if verbosity >= 1 and (run or not options['loop']):
+                self.stdout.write('Ran %s approval jobs (%s failed)\n'
+                    % (run, failed))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
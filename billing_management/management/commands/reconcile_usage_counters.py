@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import billing.usage
+
+class Command(BaseCommand):
+    help = "Recounts usage counters from the models registered with\n"  \
+    "billing.usage. Recounts every counted feature if none are given"
+    args = "[feature_name ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help='Number of accounts to recount per query'),
+    )
+
+    def handle(self, *args, **options):
+        features = args or None
+        try:
+            corrected = billing.usage.reconcile(
+                features, batch_size=options['batch_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write('\nCorrected %s usage counters\n\n' % corrected)
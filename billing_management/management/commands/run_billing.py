@@ -0,0 +1,33 @@
+import calendar
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing.invoicing import run_billing
+
+class Command(BaseCommand):
+    help = "Invoices every subscribed account for the given month.\n"  \
+    "Re-running the command for a month resumes an interrupted run"
+    args = "<YYYY-MM>"
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=500,
+            help='Number of accounts to invoice per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Exactly one argument is needed: a month')
+        try:
+            year, month = [int(i) for i in args[0].split('-')]
+            period_start = datetime.date(year, month, 1)
+        except ValueError:
+            raise CommandError('Months must be given as YYYY-MM')
+        period_end = datetime.date(
+            year, month, calendar.monthrange(year, month)[1])
+        run = run_billing(
+            period_start, period_end, chunk_size=options['chunk_size'])
+        self.stdout.write(
+            '\nBilling run for %s to %s complete: %s invoices\n\n' %
+            (period_start, period_end, run.invoices.count())
+        )
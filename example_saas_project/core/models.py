@@ -0,0 +1,12 @@
+from __future__ import absolute_import
+
+from django.db import models
+
+import billing.usage
+
+class Project(models.Model):
+    account = models.ForeignKey('billing.Account', related_name='projects')
+    name = models.CharField(max_length=100)
+
+# keep a running count of each account's projects for the Projects feature
+billing.usage.register(Project, 'Projects')
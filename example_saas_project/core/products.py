@@ -1,13 +1,17 @@
+from __future__ import absolute_import
+
 from pricing.products import Product
 from pricing.features import IntegerFeature
 from pricing.features import AllocatedFeature, MeteredFeature
 from pricing.feature_pricing import FixedInclusion, FixedUnitPricing
 from pricing.manual_intervention import ManualPreApproval, ManualPostApproval
 
+from billing.usage import get_usage
+
 class MySaaSAppAccount(Product):
     class Projects(IntegerFeature):
         def in_use(self, account):
-            return Projects.objects.filter(account=account).count()
+            return get_usage(account, 'Projects')
     
     class StorageSpace(IntegerFeature):
         """ 
@@ -0,0 +1,17 @@
+# Settings for trying out billing read replicas with the two local SQLite
+# databases of settings.py. The "replica" is a copy of the primary, so
+# (unlike a real one) it doesn't follow its writes, which makes
+# read-your-writes pinning easy to see in action:
+#
+#   ./manage.py syncdb
+#   cp /tmp/saas_project.db /tmp/saas_project_replica.db
+#   ./manage.py runserver --settings=replica_settings
+
+from settings import *
+
+DATABASE_ROUTERS = ['billing.replicas.BillingReplicaRouter']
+BILLING_REPLICA_DATABASES = ['replica']
+
+MIDDLEWARE_CLASSES = MIDDLEWARE_CLASSES + (
+    'billing.replicas.BillingReplicaMiddleware',
+)
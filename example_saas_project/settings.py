@@ -17,7 +17,14 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+    },
+    # a second database standing in for a read replica; only used when
+    # billing reads are routed to it (see replica_settings.py) and by the
+    # billing tests
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': '/tmp/saas_project_replica.db',
+    },
 }
 
 # Local time zone for this installation. Choices can be found here:
@@ -8,6 +8,7 @@ setup(
         'billing',
         'billing.processor',
         'billing.processor.simple_account',
+        'billing.processor.simple_account.migrations',
         'billing.templatetags',
         'billing.tests',
         'billing_management',
@@ -25,6 +26,9 @@ setup(
         'django-jsonfield',
         'ordereddict',
     ],
+    extras_require={
+        'vectorized': ['numpy'],
+    },
     dependency_links = [
     	'http://github.com/gabrielgrant/python-pricing/tarball/master#egg=python-pricing',
     ]